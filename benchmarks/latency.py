@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import time
+from google.appengine.api import apiproxy_rpc, apiproxy_stub_map
+
+SERVICES = ('datastore_v3', 'memcache', 'taskqueue', 'urlfetch')
+
+_started = {}
+
+_rpc_counts = {}
+
+
+def _record_start(service, call, request, response):
+    _started[id(request)] = time.time()
+
+
+def _count_rpc(service, call, request, response):
+    _rpc_counts[service] = _rpc_counts.get(service, 0) + 1
+
+
+class LatencyStub(object):
+    """
+    Wraps a service stub so each RPC completes only after latency seconds since it was started.
+    Local stubs run RPCs only when they are waited, so RPCs started together still overlap as they do on production
+    """
+
+    def __init__(self, stub, latency):
+        self._stub = stub
+        self._latency = latency
+
+    def CreateRPC(self):
+        return apiproxy_rpc.RPC(stub=self)
+
+    def MakeSyncCall(self, service, call, request, response, *args, **kwargs):
+        started = _started.pop(id(request), None)
+        if started is not None:
+            remaining = started + self._latency - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+        return self._stub.MakeSyncCall(service, call, request, response, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._stub, name)
+
+
+def inject_latency(latency, services=SERVICES):
+    """
+    Wraps stubs registered on current apiproxy, so each RPC takes at least latency seconds
+    :param latency: latency in seconds
+    :param services: services whose stubs must be wrapped. Services without stubs are ignored
+    """
+    apiproxy = apiproxy_stub_map.apiproxy
+    for service in services:
+        stub = apiproxy.GetStub(service)
+        if stub is not None:
+            apiproxy.GetPreCallHooks().Append('gaebusiness_benchmark_latency_%s' % service, _record_start, service)
+            apiproxy.ReplaceStub(service, LatencyStub(stub, latency))
+
+
+def count_rpcs():
+    """
+    Starts counting RPCs made through current apiproxy. Only benchmark code is used, so it works on any release
+    :return: dict updated with the number of RPCs by service made since this call
+    """
+    _rpc_counts.clear()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('gaebusiness_benchmark_rpc_counter', _count_rpc)
+    return _rpc_counts
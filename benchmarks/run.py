@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Runs benchmark scenarios on local testbed stubs and saves wall time and RPC counts as JSON. Ex:
+
+    GAE_SDK=/path/to/google_appengine python benchmarks/run.py -n 50 --latency 0.01 --baseline last_release.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+PROJECT_PATH = os.path.sep.join(os.path.abspath(__file__).split(os.path.sep)[:-2])
+
+
+def fix_sys_path():
+    sys.path.insert(0, PROJECT_PATH)
+    if 'GAE_SDK' in os.environ:
+        sys.path.insert(0, os.environ['GAE_SDK'])
+        import dev_appserver
+
+        dev_appserver.fix_sys_path()
+
+
+def run_scenario(scenario, n, latency):
+    from google.appengine.ext import ndb, testbed
+    from benchmarks.latency import inject_latency, count_rpcs
+
+    bed = testbed.Testbed()
+    bed.setup_env(app_id='_')
+    bed.activate()
+    try:
+        bed.init_datastore_v3_stub()
+        bed.init_memcache_stub()
+        bed.init_taskqueue_stub()
+        ndb.get_context().clear_cache()
+        timed = scenario(n)
+        ndb.get_context().clear_cache()
+        inject_latency(latency)
+        rpcs = count_rpcs()
+        begin = time.time()
+        timed()
+        wall_time = time.time() - begin
+        return wall_time, dict(rpcs)
+    finally:
+        bed.deactivate()
+
+
+def run(n, latency, repeat, names=None):
+    from benchmarks.scenarios import SCENARIOS
+
+    results = {}
+    for scenario in SCENARIOS:
+        if names and scenario.__name__ not in names:
+            continue
+        wall_times = []
+        rpcs = None
+        for _ in xrange(repeat):
+            wall_time, rpcs = run_scenario(scenario, n, latency)
+            wall_times.append(wall_time)
+        wall_times.sort()
+        results[scenario.__name__] = {'wall_time_min': wall_times[0],
+                                      'wall_time_median': wall_times[len(wall_times) // 2],
+                                      'rpcs': rpcs}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks gaebusiness commands on local testbed stubs')
+    parser.add_argument('-n', type=int, default=20, help='number of models on each scenario')
+    parser.add_argument('--latency', type=float, default=0.005, help='latency, in seconds, injected on each RPC')
+    parser.add_argument('--repeat', type=int, default=3, help='executions of each scenario')
+    parser.add_argument('--output', default='bench_output.json', help='file where results are saved as JSON')
+    parser.add_argument('--baseline', help='results file from a previous run to compare with')
+    parser.add_argument('scenarios', nargs='*', help='names of scenarios to run. All of them if omitted')
+    args = parser.parse_args()
+
+    fix_sys_path()
+    import gaebusiness
+
+    results = run(args.n, args.latency, args.repeat, args.scenarios)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+    for name in sorted(results):
+        result = results[name]
+        line = '%-20s %10.2fms  rpcs=%s' % (name, result['wall_time_median'] * 1000, result['rpcs'])
+        if name in baseline:
+            line += '  %+.1f%%' % ((result['wall_time_median'] / baseline[name]['wall_time_median'] - 1) * 100)
+        print line
+    with open(args.output, 'w') as output:
+        json.dump({'version': gaebusiness.__version__, 'n': args.n, 'latency': args.latency, 'repeat': args.repeat,
+                   'timestamp': time.time(), 'results': results}, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark scenarios. Each one receives the number of items n, prepares data and returns the callable to be timed
+"""
+from __future__ import absolute_import, unicode_literals
+from google.appengine.ext import ndb
+from gaebusiness.business import CommandParallel, CommandSequential
+from gaebusiness.gaeutil import NaiveSaveCommand, NaiveUpdateCommand, ModelSearchCommand, DeleteCommand
+
+
+class BenchModel(ndb.Model):
+    index = ndb.IntegerProperty()
+
+
+def _save_models(n):
+    return ndb.put_multi([BenchModel(index=i) for i in xrange(n)])
+
+
+def _save_commands(n):
+    return [NaiveSaveCommand(BenchModel, {'index': i}) for i in xrange(n)]
+
+
+def _update_commands(n):
+    return [NaiveUpdateCommand(BenchModel, key, {'index': -1}) for key in _save_models(n)]
+
+
+def sequential_saves(n):
+    return CommandSequential(*_save_commands(n)).execute
+
+
+def parallel_saves(n):
+    return CommandParallel(*_save_commands(n)).execute
+
+
+def sequential_updates(n):
+    return CommandSequential(*_update_commands(n)).execute
+
+
+def parallel_updates(n):
+    return CommandParallel(*_update_commands(n)).execute
+
+
+def _search_command(n):
+    return ModelSearchCommand(BenchModel.query().order(BenchModel.index), page_size=n)
+
+
+def search_cache_miss(n):
+    _save_models(n)
+    return _search_command(n).execute
+
+
+def search_cache_hit(n):
+    _save_models(n)
+    _search_command(n).execute()
+    return _search_command(n).execute
+
+
+def delete(n):
+    return DeleteCommand(*_save_models(n)).execute
+
+
+SCENARIOS = [sequential_saves, parallel_saves, sequential_updates, parallel_updates, search_cache_miss,
+             search_cache_hit, delete]
@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
+from itertools import izip
 from google.appengine.ext import ndb
+from gaebusiness.tracing import trace
+
+PUT_CHUNK_SIZE = 500
+
+# Callables notified of kinds written by each execution
+_write_observers = []
 
 
 class CommandExecutionException(Exception):
@@ -16,7 +23,51 @@ def to_model_list(models):
     return [models] if isinstance(models, ndb.Model) else models
 
 
+def to_future_list(futures):
+    if futures is None:
+        return []
+    return [futures] if isinstance(futures, ndb.Future) else futures
+
+
+def put_models_async(models, chunk_size=PUT_CHUNK_SIZE):
+    """
+    Starts saving models on DB, splitting them in chunks of chunk_size
+    :param models: list of models
+    :return: list of futures, one for each model
+    """
+    futures = []
+    for begin in xrange(0, len(models), chunk_size):
+        futures.extend(ndb.put_multi_async(models[begin:begin + chunk_size]))
+    return futures
+
+
+def add_write_observer(observer):
+    """
+    Registers a callable notified once after each execution whose commands wrote models, on any thread
+    :param observer: callable receiving a set of kinds and returning a Future, or a list of it, to be waited
+    """
+    if observer not in _write_observers:
+        _write_observers.append(observer)
+
+
+def remove_write_observer(observer):
+    if observer in _write_observers:
+        _write_observers.remove(observer)
+
+
+def _notify_writes(kinds):
+    futures = []
+    if kinds:
+        for observer in _write_observers:
+            futures.extend(to_future_list(observer(kinds)))
+    return futures
+
+
 class Command(object):
+    # True when set_up does not depend on previous commands, so CommandSequential with pipeline may call it
+    # at the beginning of the sequence
+    _independent_set_up = False
+
     def __init__(self):
         self.errors = {}
         self.result = None
@@ -42,6 +93,15 @@ class Command(object):
         """
         pass
 
+    @ndb.tasklet
+    def do_business_async(self):
+        """
+        Tasklet used by execute_async. Default implementation calls do_business.
+        Override it yielding futures instead of waiting them, so other tasklets run meanwhile
+        :return: Future
+        """
+        self.do_business()
+
     def commit(self):
         """
         Must return a Model, or a list of it to be committed on DB
@@ -49,6 +109,21 @@ class Command(object):
         if not self.errors:
             return self._to_commit
 
+    def post_commit(self):
+        """
+        Method called after models returned by commit were saved on DB.
+        It may return a Future, or a list of it, to be waited before execution finishes
+        """
+        pass
+
+    def written_kinds(self):
+        """
+        Kinds of models saved or deleted by command. They are notified to write observers after post_commit,
+        once for a whole container execution, so containers return kinds written by all commands they commit
+        :return: set of kinds
+        """
+        return set()
+
     def handle_previous(self, command):
         """
         Method called when commands are executed in sequence or parallel, so next command can access the previous
@@ -59,12 +134,47 @@ class Command(object):
         pass
 
     def execute(self):
+        with trace(self, 'execute'):
+            with trace(self, 'set_up'):
+                self.set_up()
+            self._execute_after_set_up()
+        return self
+
+    def _execute_after_set_up(self):
+        with trace(self, 'do_business'):
+            self.do_business()
+        if self.errors:
+            raise CommandExecutionException(unicode(self.errors))
+        with trace(self, 'commit'):
+            models = to_model_list(self.commit())
+        with trace(self, 'put'):
+            [f.get_result() for f in put_models_async(models)]
+        with trace(self, 'post_commit'):
+            futures = to_future_list(self.post_commit()) + _notify_writes(self.written_kinds())
+            [f.get_result() for f in futures]
+
+    @ndb.tasklet
+    def execute_async(self):
+        """
+        Executes command as a tasklet, so ndb event loop runs other tasklets while its RPCs are being waited.
+        Spans are not recorded, since they would be mixed with the ones from interleaved tasklets
+        :return: Future whose result is the command
+        """
         self.set_up()
-        self.do_business()
+        yield self._execute_after_set_up_async()
+        raise ndb.Return(self)
+
+    @ndb.tasklet
+    def _execute_after_set_up_async(self):
+        yield self.do_business_async()
         if self.errors:
             raise CommandExecutionException(unicode(self.errors))
-        ndb.put_multi(to_model_list(self.commit()))
-        return self
+        models = to_model_list(self.commit())
+        if models:
+            yield put_models_async(models)
+        futures = to_future_list(self.post_commit()) + _notify_writes(self.written_kinds())
+        if futures:
+            yield futures
 
     def __call__(self):
         self.execute()
@@ -98,17 +208,46 @@ class CommandListBase(Command):
 
 
 class CommandParallel(CommandListBase):
+    def __init__(self, *commands, **kwargs):
+        """
+        :param commands: commands to be executed in parallel
+        :param fail_fast: if True, exception is raised as soon as a command has errors, so do_business of next
+        commands is not called and their RPCs are not waited. Only errors from commands executed until then are
+        available
+        """
+        super(CommandParallel, self).__init__(*commands)
+        self.fail_fast = kwargs.get('fail_fast', False)
+
     def set_up(self):
         for cmd in self:
-            cmd.set_up()
+            with trace(cmd, 'set_up'):
+                cmd.set_up()
 
     def do_business(self):
         for cmd in self:
             try:
-                cmd.do_business()
+                with trace(cmd, 'do_business'):
+                    cmd.do_business()
             except CommandExecutionException:
                 pass
             self.update_errors(**cmd.errors)
+            if self.fail_fast:
+                self.raise_exception_if_errors()
+        self.raise_exception_if_errors()
+        if self:
+            self.result = self[-1].result
+
+    @ndb.tasklet
+    def do_business_async(self):
+        futures = [cmd.do_business_async() for cmd in self]
+        for cmd, future in izip(self, futures):
+            try:
+                yield future
+            except CommandExecutionException:
+                pass
+            self.update_errors(**cmd.errors)
+            if self.fail_fast:
+                self.raise_exception_if_errors()
         self.raise_exception_if_errors()
         if self:
             self.result = self[-1].result
@@ -116,21 +255,106 @@ class CommandParallel(CommandListBase):
     def commit(self):
         models = to_model_list(super(CommandParallel, self).commit())
         for cmd in self:
-            models.extend(to_model_list(cmd.commit()))
+            with trace(cmd, 'commit'):
+                models.extend(to_model_list(cmd.commit()))
         return models
 
+    def post_commit(self):
+        futures = to_future_list(super(CommandParallel, self).post_commit())
+        for cmd in self:
+            futures.extend(to_future_list(cmd.post_commit()))
+        return futures
+
+    def written_kinds(self):
+        return set().union(*[cmd.written_kinds() for cmd in self])
+
     def handle_previous(self, command):
         [cmd.handle_previous(command) for cmd in self]
 
 
 class CommandSequential(CommandListBase):
+    def __init__(self, *commands, **kwargs):
+        """
+        :param commands: commands to be executed in sequence
+        :param unit_of_work: if True, models returned by commands' commit are not saved after each command execution.
+        They are collected and saved all together at the end of the sequence, so none of them is saved if any command
+        fails. Only those models are deferred: writes a command makes by itself, like NaiveSaveCommand's put on set_up
+        or DeleteCommand's delete on commit, happen right away and are kept even if a later command fails.
+        Next commands still access previous ones through handle_previous, but new models have no keys yet
+        :param pipeline: if True, set_up of commands having _independent_set_up is called on sequence's set_up,
+        so their RPCs run while previous commands execute. They don't see changes made by previous commands
+        """
+        super(CommandSequential, self).__init__(*commands)
+        self.unit_of_work = kwargs.get('unit_of_work', False)
+        self.pipeline = kwargs.get('pipeline', False)
+        self.__to_commit = []
+        self.__set_up_commands = set()
+
+    def set_up(self):
+        if self.pipeline:
+            commands = [cmd for cmd in self if cmd._independent_set_up]
+            for cmd in commands:
+                with trace(cmd, 'set_up'):
+                    cmd.set_up()
+            self.__set_up_commands = set(commands)
+
+    def _execute(self, cmd):
+        if cmd in self.__set_up_commands:
+            with trace(cmd, 'execute'):
+                cmd._execute_after_set_up()
+        else:
+            cmd()
+
+    def _execute_without_saving(self, cmd):
+        if cmd not in self.__set_up_commands:
+            with trace(cmd, 'set_up'):
+                cmd.set_up()
+        with trace(cmd, 'do_business'):
+            cmd.do_business()
+        if cmd.errors:
+            raise CommandExecutionException(unicode(cmd.errors))
+        with trace(cmd, 'commit'):
+            self.__to_commit.extend(to_model_list(cmd.commit()))
+
+    @ndb.tasklet
+    def _execute_without_saving_async(self, cmd):
+        if cmd not in self.__set_up_commands:
+            cmd.set_up()
+        yield cmd.do_business_async()
+        if cmd.errors:
+            raise CommandExecutionException(unicode(cmd.errors))
+        self.__to_commit.extend(to_model_list(cmd.commit()))
+
     def do_business(self):
         previous_cmd = None
         for cmd in self:
             if previous_cmd is not None:
                 cmd.handle_previous(previous_cmd)
             try:
-                cmd()
+                if self.unit_of_work:
+                    self._execute_without_saving(cmd)
+                else:
+                    self._execute(cmd)
+            except CommandExecutionException, e:
+                self.update_errors(**cmd.errors)
+                raise e
+            previous_cmd = cmd
+        if self:
+            self.result = self[-1].result
+
+    @ndb.tasklet
+    def do_business_async(self):
+        previous_cmd = None
+        for cmd in self:
+            if previous_cmd is not None:
+                cmd.handle_previous(previous_cmd)
+            try:
+                if self.unit_of_work:
+                    yield self._execute_without_saving_async(cmd)
+                elif cmd in self.__set_up_commands:
+                    yield cmd._execute_after_set_up_async()
+                else:
+                    yield cmd.execute_async()
             except CommandExecutionException, e:
                 self.update_errors(**cmd.errors)
                 raise e
@@ -138,5 +362,138 @@ class CommandSequential(CommandListBase):
         if self:
             self.result = self[-1].result
 
+    def commit(self):
+        models = to_model_list(super(CommandSequential, self).commit())
+        return models + self.__to_commit
+
+    def post_commit(self):
+        futures = to_future_list(super(CommandSequential, self).post_commit())
+        if self.unit_of_work:
+            for cmd in self:
+                futures.extend(to_future_list(cmd.post_commit()))
+        return futures
+
+    def written_kinds(self):
+        # Without unit of work, each command notifies its own writes when executed, so next ones see them
+        if self.unit_of_work:
+            return set().union(*[cmd.written_kinds() for cmd in self])
+        return set()
+
     def handle_previous(self, command):
         self[0].handle_previous(command)
+
+
+class CommandGraph(CommandListBase):
+    """
+    Executes commands respecting explicit dependencies among them.
+    Each command runs on its own tasklet, whose set_up is started as soon as its own dependencies finished
+    do_business_async, without waiting for other branches. So graph takes as long as its slowest path.
+    Spans are not recorded for commands' do_business, since tasklets are interleaved.
+    Models from all commands are committed together at the end
+    """
+
+    def __init__(self, *commands):
+        super(CommandGraph, self).__init__(*commands)
+        self.__dependencies = {}
+        self.__order = []
+
+    def add(self, cmd, *dependencies):
+        """
+        Appends a command which must be executed only after its dependencies.
+        It receives each of them on handle_previous, in the same order, just before its set_up
+        :param cmd: command to be appended
+        :param dependencies: commands already on graph
+        :return: cmd, so it can be used as dependency of next commands
+        """
+        self.append(cmd)
+        self.__dependencies[cmd] = list(dependencies)
+        return cmd
+
+    def dependencies(self, cmd):
+        return self.__dependencies.get(cmd, [])
+
+    def topological_order(self):
+        dependents = dict((cmd, []) for cmd in self)
+        pending = {}
+        for cmd in self:
+            for dependency in self.dependencies(cmd):
+                if dependency not in dependents:
+                    raise Exception('Dependency %s of command %s is not on graph' % (dependency, cmd))
+                dependents[dependency].append(cmd)
+            pending[cmd] = len(self.dependencies(cmd))
+        ready = [cmd for cmd in self if not pending[cmd]]
+        order = []
+        while ready:
+            cmd = ready.pop(0)
+            order.append(cmd)
+            for dependent in dependents[cmd]:
+                pending[dependent] -= 1
+                if not pending[dependent]:
+                    ready.append(dependent)
+        if len(order) != len(self):
+            raise Exception('Dependencies among commands must not have cycles')
+        return order, dependents
+
+    def _set_up_command(self, cmd, traced=True):
+        for dependency in self.dependencies(cmd):
+            cmd.handle_previous(dependency)
+        if traced:
+            with trace(cmd, 'set_up'):
+                cmd.set_up()
+        else:
+            cmd.set_up()
+
+    def set_up(self):
+        self.__order = self.topological_order()[0]
+        for cmd in self:
+            if not self.dependencies(cmd):
+                self._set_up_command(cmd)
+
+    @ndb.tasklet
+    def _execute_command_async(self, cmd, dependencies_futures, traced):
+        if dependencies_futures:
+            yield dependencies_futures
+            # Other branches may have failed meanwhile
+            self.raise_exception_if_errors()
+            self._set_up_command(cmd, traced)
+        try:
+            yield cmd.do_business_async()
+        except CommandExecutionException:
+            pass
+        self.update_errors(**cmd.errors)
+        self.raise_exception_if_errors()
+
+    @ndb.tasklet
+    def _do_business_async(self, traced):
+        futures = {}
+        for cmd in self.__order:
+            futures[cmd] = self._execute_command_async(cmd, [futures[d] for d in self.dependencies(cmd)], traced)
+        # All are waited, so no tasklet is left running after an error
+        yield [futures[cmd] for cmd in self.__order]
+        if self:
+            self.result = self.__order[-1].result
+
+    def do_business(self):
+        self._do_business_async(True).get_result()
+
+    def do_business_async(self):
+        return self._do_business_async(False)
+
+    def commit(self):
+        models = to_model_list(super(CommandGraph, self).commit())
+        for cmd in self:
+            with trace(cmd, 'commit'):
+                models.extend(to_model_list(cmd.commit()))
+        return models
+
+    def post_commit(self):
+        futures = to_future_list(super(CommandGraph, self).post_commit())
+        for cmd in self:
+            futures.extend(to_future_list(cmd.post_commit()))
+        return futures
+
+    def written_kinds(self):
+        return set().union(*[cmd.written_kinds() for cmd in self])
+
+    def handle_previous(self, command):
+        [cmd.handle_previous(command) for cmd in self if not self.dependencies(cmd)]
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import threading
+import time
+from google.appengine.api import memcache
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+SHARED_KEY_PREFIX = 'gaebusiness:circuit:'
+
+
+class _HostState(object):
+    def __init__(self):
+        self.state = CLOSED
+        self.requests = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.window_started = time.time()
+        self.opened_at = None
+        self.probes = 0
+        self.probed_at = None
+        self.shared_checked_at = None
+
+
+class CircuitBreaker(object):
+    """
+    Thread safe circuit breaker keeping a state for each host.
+    A closed circuit opens when, inside a window, timeouts reach timeout_threshold or failures reach error_rate of at
+    least min_requests requests. An open circuit rejects requests until cool_down seconds are over, and then it is
+    half open, letting up to probes requests through. A success closes it again and a failure opens it. Probes whose
+    outcome is not recorded within cool_down seconds are given up, so new probes are let through.
+    If shared, circuits opened on other instances are read from memcache, checked at most every sync_interval seconds.
+    Memcache is accessed out of the lock, so a slow call only delays the thread making it
+    """
+
+    def __init__(self, error_rate=0.5, min_requests=10, timeout_threshold=5, window=60, cool_down=30, probes=1,
+                 shared=False, sync_interval=5):
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.timeout_threshold = timeout_threshold
+        self.window = window
+        self.cool_down = cool_down
+        self.probes = probes
+        self.shared = shared
+        self.sync_interval = sync_interval
+        self.transitions = {OPEN: 0, HALF_OPEN: 0, CLOSED: 0}
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _host_state(self, host):
+        host_state = self._hosts.get(host)
+        if host_state is None:
+            host_state = self._hosts[host] = _HostState()
+        return host_state
+
+    def _transition(self, host_state, state):
+        host_state.state = state
+        host_state.requests = host_state.failures = host_state.timeouts = host_state.probes = 0
+        host_state.window_started = time.time()
+        self.transitions[state] += 1
+
+    def _open(self, host_state, opened_at=None):
+        self._transition(host_state, OPEN)
+        host_state.opened_at = opened_at or time.time()
+
+    def _claim_sync(self, host):
+        """
+        :return: True if circuit is closed and sync_interval is over. Only one thread gets it on each interval
+        """
+        with self._lock:
+            host_state = self._host_state(host)
+            now = time.time()
+            if host_state.state == CLOSED and (host_state.shared_checked_at is None or
+                                               host_state.shared_checked_at + self.sync_interval <= now):
+                host_state.shared_checked_at = now
+                return True
+            return False
+
+    def _sync_shared(self, host):
+        opened_at = memcache.get(SHARED_KEY_PREFIX + host)
+        if opened_at is not None:
+            with self._lock:
+                host_state = self._host_state(host)
+                # State may have changed while memcache was read
+                if host_state.state == CLOSED:
+                    self._open(host_state, opened_at)
+
+    def state(self, host):
+        with self._lock:
+            return self._host_state(host).state
+
+    def allow(self, host):
+        """
+        :return: True if a request to host may be done. Caller must report its outcome with record_success or
+        record_failure
+        """
+        if self.shared and self._claim_sync(host):
+            self._sync_shared(host)
+        with self._lock:
+            host_state = self._host_state(host)
+            if host_state.state == OPEN:
+                if host_state.opened_at + self.cool_down > time.time():
+                    return False
+                self._transition(host_state, HALF_OPEN)
+            if host_state.state == HALF_OPEN:
+                if host_state.probes >= self.probes:
+                    if host_state.probed_at + self.cool_down > time.time():
+                        return False
+                    host_state.probes = 0
+                host_state.probes += 1
+                host_state.probed_at = time.time()
+            return True
+
+    def record_success(self, host):
+        with self._lock:
+            host_state = self._host_state(host)
+            if host_state.state == HALF_OPEN:
+                self._transition(host_state, CLOSED)
+            elif host_state.state == CLOSED:
+                self._count(host_state)
+
+    def record_failure(self, host, timeout=False):
+        opened_at = None
+        with self._lock:
+            host_state = self._host_state(host)
+            if host_state.state == HALF_OPEN:
+                self._open(host_state)
+                opened_at = host_state.opened_at
+            elif host_state.state == CLOSED:
+                self._count(host_state)
+                host_state.failures += 1
+                if timeout:
+                    host_state.timeouts += 1
+                if host_state.timeouts >= self.timeout_threshold or (
+                                host_state.requests >= self.min_requests and
+                                host_state.failures >= self.error_rate * host_state.requests):
+                    self._open(host_state)
+                    opened_at = host_state.opened_at
+        if self.shared and opened_at is not None:
+            memcache.set(SHARED_KEY_PREFIX + host, opened_at, time=self.cool_down)
+
+    def _count(self, host_state):
+        if host_state.window_started + self.window <= time.time():
+            host_state.requests = host_state.failures = host_state.timeouts = 0
+            host_state.window_started = time.time()
+        host_state.requests += 1
+
+    def stats(self):
+        with self._lock:
+            return {'transitions': dict(self.transitions),
+                    'hosts': dict((host, host_state.state) for host, host_state in self._hosts.iteritems())}
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import datetime
+import hashlib
+from google.appengine.api import datastore_types, namespace_manager
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb import query as ndb_query
+
+FINGERPRINT_PREFIX = 'gaebusiness:query:'
+
+
+def _canonical_value(value):
+    if isinstance(value, ndb.Key):
+        return 'key', value.urlsafe()
+    if isinstance(value, datastore_types.Key):
+        return 'key', ndb.Key.from_old_key(value).urlsafe()
+    if isinstance(value, bool):
+        return 'bool', value
+    if isinstance(value, (int, long)):
+        return 'int', int(value)
+    if isinstance(value, basestring):
+        return 'str', value.decode('utf-8') if isinstance(value, str) else value
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return type(value).__name__, value.isoformat()
+    if isinstance(value, (list, tuple)):
+        return 'list', tuple(_canonical_value(v) for v in value)
+    return type(value).__name__, repr(value)
+
+
+def _canonical_filters(node):
+    if node is None:
+        return None
+    if isinstance(node, ndb_query.ConjunctionNode):
+        return 'AND', tuple(sorted(_canonical_filters(n) for n in node))
+    if isinstance(node, ndb_query.DisjunctionNode):
+        return 'OR', tuple(sorted(_canonical_filters(n) for n in node))
+    if isinstance(node, ndb_query.FilterNode):
+        name, op, value = node.__getnewargs__()
+        return 'FILTER', _canonical_value(name)[1], _canonical_value(op)[1], _canonical_value(value)
+    if isinstance(node, ndb_query.PostFilterNode):
+        predicate = node.predicate
+        if hasattr(predicate, '__dict__'):
+            return 'POST', type(predicate).__name__, repr(sorted(vars(predicate).items()))
+        return 'POST', repr(predicate)
+    return type(node).__name__, repr(node)
+
+
+def _canonical_orders(orders):
+    if orders is None:
+        return ()
+    orders = getattr(orders, 'orders', [orders])
+    return tuple((o.prop, o.direction) if hasattr(o, 'prop') else repr(o) for o in orders)
+
+
+def _property_names(properties):
+    return tuple(sorted(_canonical_value(getattr(p, '_name', p))[1] for p in properties or ()))
+
+
+def canonical_query(query, page_size=None, offset=0, start_cursor=None, **extra):
+    """
+    Normalizes query and page arguments into a tuple, which is the same for equivalent queries
+    :param extra: any other argument changing query results
+    """
+    namespace = query.namespace
+    if namespace is None:
+        namespace = namespace_manager.get_namespace()
+    if isinstance(start_cursor, basestring):
+        start_cursor = ndb_query.Cursor(urlsafe=start_cursor)
+    return (('app', query.app),
+            ('namespace', namespace),
+            ('kind', query.kind),
+            ('ancestor', query.ancestor and query.ancestor.urlsafe()),
+            ('filters', _canonical_filters(query.filters)),
+            ('orders', _canonical_orders(query.orders)),
+            ('projection', _property_names(query.projection)),
+            ('group_by', _property_names(query.group_by)),
+            ('page_size', page_size),
+            ('offset', offset or 0),
+            ('cursor', start_cursor and start_cursor.urlsafe()),
+            ('extra', tuple(sorted((k, _canonical_value(v)) for k, v in extra.iteritems()))))
+
+
+def query_fingerprint(query, page_size=None, offset=0, start_cursor=None, **extra):
+    """
+    Builds a fixed size key, which fits on memcache limit, from query and page arguments
+    :return: str prefixed by FINGERPRINT_PREFIX
+    """
+    canonical = canonical_query(query, page_size, offset, start_cursor, **extra)
+    return str('%s%s' % (FINGERPRINT_PREFIX, hashlib.sha1(repr(canonical)).hexdigest()))
@@ -1,17 +1,364 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
+import hashlib
+import pickle
+import random
+import sys
+import threading
+import time
 import urllib
-from google.appengine.api import urlfetch, taskqueue, memcache
+import urlparse
+from collections import deque
+from google.appengine.api import urlfetch, taskqueue
 from google.appengine.api.taskqueue import Task
 from google.appengine.api.taskqueue import Queue
-from google.appengine.ext import ndb
+from google.appengine.datastore import entity_pb, datastore_query
+from google.appengine.ext import ndb, deferred
+from google.appengine.ext.ndb import eventloop
 from google.appengine.ext.ndb.query import Cursor
-from gaebusiness.business import Command
+from gaebusiness.business import Command, to_model_list, add_write_observer
+from gaebusiness.circuit import CLOSED
+from gaebusiness.fingerprint import query_fingerprint, FINGERPRINT_PREFIX
+from gaebusiness.metrics import Histogram
+
+GENERATION_KEY_PREFIX = 'gaebusiness:generation:'
+# Max number of page boundaries cursors kept for each query by ModelSearchCommand offset translation
+OFFSET_CURSORS_LIMIT = 100
+HTTP_CACHE_KEY_PREFIX = 'gaebusiness:http:'
+# Methods which may be hedged by UrlFetchCommand, since sending them twice has the same effect as sending once
+IDEMPOTENT_METHODS = (urlfetch.GET, urlfetch.HEAD, urlfetch.PUT, urlfetch.DELETE)
+# Url handled by deferred builtin, which must be enabled on app.yaml for search pages refresh
+DEFERRED_URL = '/_ah/queue/deferred'
+
+# Generations of kinds invalidated on this instance, used to discard pages cached on ModelSearchCommand.local_cache
+_local_generations = {}
+
+
+def _generation_key(kind):
+    return '%s%s' % (GENERATION_KEY_PREFIX, kind or '')
+
+
+def _new_generation():
+    # Greater than any previous generation, so entries cached before the counter was evicted stay invalid
+    return int(time.time() * 1000)
+
+
+def _kinds(models_or_keys):
+    return set(m.kind() if isinstance(m, ndb.Key) else m._get_kind() for m in to_model_list(models_or_keys))
+
+
+def invalidate_search_cache(*kinds):
+    """
+    Bumps kinds generations, so ModelSearchCommand stops reading pages cached for them
+    :param kinds: kinds names
+    :return: list of futures
+    """
+    context = ndb.get_context()
+    kinds = set(kinds)
+    for kind in kinds:
+        _local_generations[kind] = _local_generations.get(kind, 0) + 1
+    return [context.memcache_incr(_generation_key(kind), initial_value=_new_generation()) for kind in kinds]
+
+
+def _invalidate_written_kinds(kinds):
+    if ModelSearchCommand.invalidate_on_write:
+        return invalidate_search_cache(*kinds)
+
+
+add_write_observer(_invalidate_written_kinds)
+
+
+def _encode_projected(model):
+    # Projected entities can not be pickled because their required properties may be missing
+    return model._to_pb(allow_partial=True).Encode()
+
+
+def _decode_projected(encoded, projection):
+    pb = entity_pb.EntityProto(encoded)
+    model = ndb.Model._lookup_model(pb.key().path().element_list()[-1].type())._from_pb(pb)
+    model._set_projection(projection)
+    return model
+
+
+def _query_state(query):
+    # ndb queries can not be pickled because of their orders
+    orders = query.orders and [(o.prop, o.direction) for o in getattr(query.orders, 'orders', [query.orders])]
+    return (query.kind, query.ancestor, query.filters, orders, query.app, query.namespace,
+            query.projection and [getattr(p, '_name', p) for p in query.projection],
+            query.group_by and [getattr(p, '_name', p) for p in query.group_by])
+
+
+def _query_from_state(state):
+    kind, ancestor, filters, orders, app, namespace, projection, group_by = state
+    if orders:
+        orders = datastore_query.CompositeOrder([datastore_query.PropertyOrder(p, d) for p, d in orders])
+    return ndb.Query(kind=kind, ancestor=ancestor, filters=filters, orders=orders, app=app, namespace=namespace,
+                     projection=projection, group_by=group_by)
+
+
+def refresh_search_page(query_state, page_size, start_cursor, offset, projection):
+    '''
+    Task executing ModelSearchCommand query and caching its page, enqueued when page soft ttl is expired
+    '''
+    search = ModelSearchCommand(_query_from_state(query_state), page_size, start_cursor, offset, projection=projection)
+    search._refresh_async().get_result()
+
+
+class RetryPolicy(object):
+    """
+    Defines how UrlFetchCommand retries a fetch failing with a retryable status code, a DownloadError, including
+    DeadlineExceededError, or an InternalTransientError
+    """
+
+    def __init__(self, max_attempts=3, backoff=0.1, max_backoff=2, retry_status_codes=(500, 502, 503, 504),
+                 budget=None):
+        """
+        :param max_attempts: max number of fetches, including the first one
+        :param backoff: seconds used as base of exponential backoff between attempts
+        :param max_backoff: max seconds between attempts
+        :param retry_status_codes: status codes which cause a retry
+        :param budget: max seconds spent by all attempts and waits. No retry starts after it is over
+        """
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_status_codes = retry_status_codes
+        self.budget = budget
+
+    def delay(self, attempt):
+        """
+        :param attempt: number of attempts already made
+        :return: random seconds to wait before next attempt, up to an exponentially growing limit
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+
+class _HostHedges(object):
+    def __init__(self):
+        self.latencies = Histogram()
+        self.in_flight = 0
+        self.hedges = 0
+        self.wins = 0
+
+
+class HedgePolicy(object):
+    """
+    Thread safe policy, usually shared by all commands, defining when UrlFetchCommand sends a second identical fetch
+    if the first one is taking too long. The first response to arrive is used and the other is ignored.
+    Latencies of successful fetches are kept for each host, so hedges can be sent after the observed percentile
+    """
+
+    def __init__(self, delay=None, percentile=95, min_samples=20, max_in_flight=5):
+        """
+        :param delay: seconds waited for a response before hedging. If None, host's observed percentile is used
+        :param percentile: latency percentile used as delay when delay is None
+        :param min_samples: min number of latencies observed for a host before hedging based on its percentile
+        :param max_in_flight: max number of hedges running at the same time for each host
+        """
+        self.delay = delay
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_in_flight = max_in_flight
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _host_hedges(self, host):
+        host_hedges = self._hosts.get(host)
+        if host_hedges is None:
+            host_hedges = self._hosts[host] = _HostHedges()
+        return host_hedges
+
+    def hedge_delay(self, host):
+        """
+        :return: seconds to wait before hedging a fetch to host or None if it must not be hedged
+        """
+        if self.delay is not None:
+            return self.delay
+        with self._lock:
+            latencies = self._host_hedges(host).latencies
+            if latencies.count < self.min_samples:
+                return None
+            return latencies.percentile(self.percentile) / 1000.0
+
+    def observe(self, host, seconds):
+        with self._lock:
+            self._host_hedges(host).latencies.observe(seconds * 1000)
+
+    def start_hedge(self, host):
+        """
+        :return: True if a hedge to host may be sent. Caller must report its end with end_hedge
+        """
+        with self._lock:
+            host_hedges = self._host_hedges(host)
+            if host_hedges.in_flight >= self.max_in_flight:
+                return False
+            host_hedges.in_flight += 1
+            host_hedges.hedges += 1
+            return True
+
+    def end_hedge(self, host, won):
+        with self._lock:
+            host_hedges = self._host_hedges(host)
+            host_hedges.in_flight -= 1
+            if won:
+                host_hedges.wins += 1
+
+    def stats(self):
+        with self._lock:
+            return dict((host, {'hedges': host_hedges.hedges,
+                                'wins': host_hedges.wins,
+                                'in_flight': host_hedges.in_flight,
+                                'p%s_ms' % self.percentile: host_hedges.latencies.percentile(self.percentile)})
+                        for host, host_hedges in self._hosts.iteritems())
+
+
+def _fetch_succeeded(outcome):
+    """
+    :param outcome: tuple with fetch result, exception and exc_info raised by fetch, only one of them not being None
+    """
+    return outcome[1] is None and outcome[2] is None
+
+
+def _next_loop_turn():
+    """
+    :return: future done on event loop's next iteration, so tasklets yielding it let other ready tasklets run first
+    """
+    future = ndb.Future()
+    eventloop.queue_call(None, future.set_result, None)
+    return future
+
+
+class _HedgedFetches(object):
+    """
+    Primary and hedge fetches of an UrlFetchCommand, each one done synchronously on its own thread. A urlfetch RPC
+    can't be waited with a timeout, and ndb timers don't fire while ndb waits an RPC, so the hedge delay is waited
+    on a thread too
+    """
+
+    def __init__(self, cmd, deadline, delay):
+        """
+        :param delay: seconds waited for primary's outcome before hedging or None if fetch must not be hedged
+        """
+        self._cmd = cmd
+        self._started = time.time()
+        self._deadline = deadline
+        self._condition = threading.Condition()
+        self._outcomes = []
+        self._hedging = False
+        self._closed = False
+        self._start(self._fetch_primary)
+        if delay is not None and delay < deadline:
+            self._start(self._fetch_hedge, delay)
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def _fetch(self, deadline):
+        try:
+            result, error = self._cmd._timed_fetch(deadline)
+            return result, error, None
+        except Exception:
+            return None, None, sys.exc_info()
+
+    def _fetch_primary(self):
+        outcome = self._fetch(self._deadline)
+        with self._condition:
+            self._outcomes.append(outcome)
+            self._condition.notify_all()
+
+    def _fetch_hedge(self, delay):
+        cmd, host = self._cmd, self._cmd._host()
+        with self._condition:
+            # Only notified when primary finishes
+            self._condition.wait(delay)
+            if self._outcomes or self._closed or (
+                            cmd.circuit_breaker is not None and cmd.circuit_breaker.state(host) != CLOSED) or (
+                    not cmd.hedge_policy.start_hedge(host)):
+                return
+            self._hedging = True
+            cmd.hedges += 1
+        won = False
+        try:
+            outcome = self._fetch(self._deadline - (time.time() - self._started))
+            with self._condition:
+                won = _fetch_succeeded(outcome) and not any(_fetch_succeeded(o) for o in self._outcomes)
+                self._outcomes.append(outcome)
+                self._condition.notify_all()
+        finally:
+            # Hedges in flight are always released, even if command doesn't wait for this one
+            cmd.hedge_won = won
+            cmd.hedge_policy.end_hedge(host, won)
+
+    def _finished(self):
+        return any(_fetch_succeeded(o) for o in self._outcomes) or (
+            self._outcomes and (not self._hedging or len(self._outcomes) == 2))
+
+    def wait(self):
+        """
+        Blocks until first fetch succeeds. If the first fetch to finish fails, returning or raising an exception, the
+        other one is waited, if it was sent
+        :return: tuple with successful fetch result and None or last fetch outcome
+        """
+        with self._condition:
+            while not self._finished():
+                self._condition.wait()
+            self._closed = True
+            succeeded = [o for o in self._outcomes if _fetch_succeeded(o)]
+            result, error, exc_info = succeeded[0] if succeeded else self._outcomes[-1]
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return result, error
+
+
+def _cache_control_max_age(headers):
+    """
+    :return: seconds response may be served without revalidation or None if it must not be stored
+    """
+    max_age = 0
+    for directive in headers.get('Cache-Control', '').split(','):
+        directive = directive.strip().lower()
+        if directive in ('no-store', 'private'):
+            return None
+        if directive.startswith('max-age='):
+            try:
+                max_age = int(directive[len('max-age='):])
+            except ValueError:
+                pass
+    return 0 if 'no-cache' in headers.get('Cache-Control', '').lower() else max_age
+
+
+class CachedResponse(object):
+    """
+    Response served by UrlFetchCommand from its HTTP cache, with the same attributes used from urlfetch results
+    """
+
+    def __init__(self, entry):
+        self.status_code = entry['status_code']
+        self.content = entry['content']
+        # Same case insensitive mapping used by urlfetch results
+        self.headers = urlfetch._CaselessDict(entry['headers'])
+        self.final_url = entry['final_url']
 
 
 class UrlFetchCommand(Command):
     def __init__(self, url, params={}, method=urlfetch.GET, headers={}, validate_certificate=True, deadline=30,
+                 retry_policy=None, circuit_breaker=None, http_cache=False, cache_headers=(), hedge_policy=None,
                  **kwargs):
+        """
+        :param retry_policy: RetryPolicy. If given, failed fetches are started again as new async RPCs, so fetches
+        from other commands keep overlapping with retries
+        :param circuit_breaker: CircuitBreaker, usually shared by all commands. Fetches to a host whose circuit is
+        open are not done, and command fails immediately with a 'circuit' error
+        :param http_cache: if True, GET responses with ETag or Last-Modified validators, or with Cache-Control max-age,
+        are kept on memcache. They are served without fetching while max-age is fresh. Otherwise they are revalidated
+        with If-None-Match and If-Modified-Since headers and served again on a 304 response
+        :param cache_headers: names of request headers whose values are part of cache key, besides method and url
+        :param hedge_policy: HedgePolicy, usually shared by all commands. If given and method is idempotent, a second
+        fetch is sent when no response arrived after policy's delay, and the first response is used. Hedged fetches
+        are done on threads, so delay is measured even while ndb waits other RPCs
+        """
         super(UrlFetchCommand, self).__init__()
         self.method = method
         self.headers = headers
@@ -19,6 +366,18 @@ class UrlFetchCommand(Command):
         self.url = url
         self.params = None
         self.deadline = deadline
+        self.retry_policy = retry_policy
+        self.circuit_breaker = circuit_breaker
+        self.http_cache = http_cache and method == urlfetch.GET
+        self.cache_headers = cache_headers
+        self.hedge_policy = hedge_policy if method in IDEMPOTENT_METHODS else None
+        self.from_cache = False
+        self.attempts = 0
+        self.hedges = 0
+        self.hedge_won = False
+        self.__future = None
+        self.__rejected = False
+        self.__request_headers = headers
         if params:
             encoded_params = urllib.urlencode(params)
             if method in (urlfetch.POST, urlfetch.PUT, urlfetch.PATCH):
@@ -26,19 +385,251 @@ class UrlFetchCommand(Command):
             else:
                 self.url = "%s?%s" % (url, encoded_params)
 
+    def _host(self):
+        return urlparse.urlparse(self.url).netloc
+
+    def _record_attempt(self, rpc):
+        # Called back as soon as rpc finishes, so outcome is recorded even if do_business is never called
+        result = error = None
+        try:
+            result = rpc.get_result()
+        except urlfetch.Error, e:
+            error = e
+        if error is not None:
+            self.circuit_breaker.record_failure(self._host(), isinstance(error, urlfetch.DeadlineExceededError))
+        elif result.status_code >= 500:
+            self.circuit_breaker.record_failure(self._host())
+        else:
+            self.circuit_breaker.record_success(self._host())
+
+    def _make_fetch_call(self, deadline):
+        if self.circuit_breaker is None:
+            rpc = urlfetch.create_rpc(deadline=deadline)
+        else:
+            rpc = urlfetch.create_rpc(deadline=deadline, callback=lambda: self._record_attempt(rpc))
+        urlfetch.make_fetch_call(rpc, self.url, self.params, method=self.method,
+                                 validate_certificate=self.validate_certificate, headers=self.__request_headers)
+        self.attempts += 1
+        return rpc
+
     def set_up(self):
-        self._rpc = urlfetch.create_rpc(deadline=self.deadline)
-        urlfetch.make_fetch_call(self._rpc, self.url, self.params, method=self.method,
-                                 validate_certificate=self.validate_certificate, headers=self.headers)
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow(self._host()):
+            self.__rejected = True
+        elif self.http_cache:
+            self.__future = self._fetch_with_http_cache_async()
+        elif self.retry_policy is not None:
+            self.__future = self._fetch_with_retries_async()
+        elif self.hedge_policy is not None:
+            self.__future = self._fetch_with_hedge_async(self.deadline)
+        else:
+            self._rpc = self._make_fetch_call(self.deadline)
+
+    @ndb.tasklet
+    def _fetch_with_retries_async(self):
+        """
+        :return: tuple with last fetch result and exception, one of them being None
+        """
+        policy = self.retry_policy
+        started = time.time()
+        while True:
+            deadline = self.deadline
+            if policy.budget is not None:
+                deadline = min(deadline, started + policy.budget - time.time())
+            result, error = yield self._fetch_async(deadline)
+            if error is None and result.status_code not in policy.retry_status_codes:
+                raise ndb.Return(result, None)
+            delay = policy.delay(self.attempts)
+            if self.attempts >= policy.max_attempts or (
+                            policy.budget is not None and time.time() + delay >= started + policy.budget) or (
+                            self.circuit_breaker is not None and not self.circuit_breaker.allow(self._host())):
+                raise ndb.Return(result, error)
+            yield ndb.sleep(delay)
+
+    def _http_cache_key(self):
+        headers = sorted((name.lower(), value) for name, value in self.headers.iteritems()
+                         if name.lower() in [h.lower() for h in self.cache_headers])
+        return str(HTTP_CACHE_KEY_PREFIX + hashlib.sha1(repr((self.method, self.url, headers))).hexdigest())
+
+    @ndb.tasklet
+    def _wait_fetch_async(self, rpc):
+        try:
+            result = yield rpc
+        except (urlfetch.DownloadError, urlfetch.InternalTransientError), e:
+            raise ndb.Return(None, e)
+        raise ndb.Return(result, None)
+
+    def _fetch_async(self, deadline):
+        if self.hedge_policy is None:
+            return self._wait_fetch_async(self._make_fetch_call(deadline))
+        return self._fetch_with_hedge_async(deadline)
 
+    def _timed_fetch(self, deadline):
+        """
+        Fetches synchronously, observing latency of successful fetches on hedge policy
+        :return: tuple with fetch result and exception, one of them being None
+        """
+        started = time.time()
+        try:
+            result = self._make_fetch_call(deadline).get_result()
+        except (urlfetch.DownloadError, urlfetch.InternalTransientError), e:
+            return None, e
+        self.hedge_policy.observe(self._host(), time.time() - started)
+        return result, None
+
+    @ndb.tasklet
+    def _fetch_with_hedge_async(self, deadline):
+        """
+        :return: tuple with first successful fetch result and None, or last fetch result and exception
+        """
+        fetches = _HedgedFetches(self, deadline, self.hedge_policy.hedge_delay(self._host()))
+        # Fetches already run on their threads, so other ready tasklets, like other commands' set_up, go first
+        yield _next_loop_turn()
+        raise ndb.Return(fetches.wait())
+
+    @ndb.tasklet
+    def _fetch_with_http_cache_async(self):
+        """
+        :return: tuple with response, fetched or cached, and exception, one of them being None
+        """
+        context = ndb.get_context()
+        cache_key = self._http_cache_key()
+        entry = yield context.memcache_get(cache_key)
+        if entry and entry['expires_at'] > time.time():
+            self.from_cache = True
+            raise ndb.Return(CachedResponse(entry), None)
+        if entry:
+            self.__request_headers = dict(self.headers)
+            if entry['etag']:
+                self.__request_headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                self.__request_headers['If-Modified-Since'] = entry['last_modified']
+        if self.retry_policy is None:
+            result, error = yield self._fetch_async(self.deadline)
+        else:
+            result, error = yield self._fetch_with_retries_async()
+        if error is None:
+            if result.status_code == 304 and entry:
+                entry['expires_at'] = time.time() + (_cache_control_max_age(result.headers) or 0)
+                yield context.memcache_set(cache_key, entry)
+                self.from_cache = True
+                raise ndb.Return(CachedResponse(entry), None)
+            max_age = _cache_control_max_age(result.headers)
+            etag, last_modified = result.headers.get('ETag'), result.headers.get('Last-Modified')
+            if result.status_code == 200 and max_age is not None and (max_age or etag or last_modified):
+                entry = {'status_code': result.status_code,
+                         'content': result.content,
+                         'headers': dict(result.headers),
+                         'final_url': getattr(result, 'final_url', None),
+                         'etag': etag,
+                         'last_modified': last_modified,
+                         'expires_at': time.time() + max_age}
+                yield context.memcache_set(cache_key, entry)
+        raise ndb.Return(result, error)
 
     def do_business(self, stop_on_error=False):
-        self.result = self._rpc.get_result()
+        if self.__rejected:
+            self.add_error('circuit', 'Circuit open for host %s' % self._host())
+            return
+        if self.__future is None:
+            try:
+                self.result, error = self._rpc.get_result(), None
+            except (urlfetch.DownloadError, urlfetch.InternalTransientError), e:
+                error = e
+        else:
+            self.result, error = self.__future.get_result()
+        if error is not None:
+            self.add_error('fetch', '%s: %s' % (error.__class__.__name__, error))
+            return
         http_code = self.result.status_code
-        if 400 <= http_code <= 499:
+        if 400 <= http_code <= 599:
             self.add_error('http', http_code)
             self.add_error('content', getattr(self.result, 'content', 'No content to show'))
 
+    @ndb.tasklet
+    def do_business_async(self):
+        if self.__future is None and not self.__rejected:
+            self.__future = self._wait_fetch_async(self._rpc)
+        if self.__future is not None:
+            yield self.__future
+        self.do_business()
+
+
+class UrlFetchBatchCommand(Command):
+    """
+    Fetches urls keeping at most max_in_flight fetches running. A new fetch starts as soon as one finishes.
+    Each url is fetched by an UrlFetchCommand, so its errors are collected on url_errors without stopping the batch
+    """
+
+    def __init__(self, urls, max_in_flight=10, callback=None, **fetch_kwargs):
+        """
+        :param urls: iterable of urls, consumed only as fetches are started
+        :param max_in_flight: max number of fetches running at the same time
+        :param callback: callable receiving each url and its finished UrlFetchCommand. If given, responses are not
+        kept, so result is None. Otherwise result is the list of responses, in urls order, None for failed ones
+        :param fetch_kwargs: arguments used to build each UrlFetchCommand, like headers, deadline or retry_policy
+        """
+        super(UrlFetchBatchCommand, self).__init__()
+        self.urls = urls
+        self.max_in_flight = max_in_flight
+        self.callback = callback
+        self.fetch_kwargs = fetch_kwargs
+        self.url_errors = {}
+        self.__future = None
+        self.__responses = {}
+
+    def _on_fetch(self, index, url, cmd):
+        if cmd.errors:
+            self.url_errors[url] = cmd.errors
+        if self.callback is None:
+            self.__responses[index] = cmd.result
+        else:
+            self.callback(url, cmd)
+
+    @ndb.tasklet
+    def _fetch_next_async(self, indexed_urls, on_fetch):
+        # All workers share the same iterator, so each url is fetched only once
+        for index, url in indexed_urls:
+            cmd = UrlFetchCommand(url, **self.fetch_kwargs)
+            # Running business directly keeps errors on cmd instead of raising them through the event loop
+            try:
+                cmd.set_up()
+                yield cmd.do_business_async()
+            except urlfetch.Error, e:
+                cmd.add_error('fetch', '%s: %s' % (e.__class__.__name__, e))
+            on_fetch(index, url, cmd)
+
+    def _start(self, on_fetch):
+        indexed_urls = enumerate(iter(self.urls))
+        return [self._fetch_next_async(indexed_urls, on_fetch) for _ in xrange(self.max_in_flight)]
+
+    def set_up(self):
+        self.__future = self._start(self._on_fetch)
+
+    def do_business(self, stop_on_error=False):
+        for future in self.__future:
+            future.get_result()
+        if self.callback is None:
+            self.result = [self.__responses[index] for index in xrange(len(self.__responses))]
+            self.__responses = {}
+
+    def iter_fetches(self):
+        """
+        Generator running the batch without executing the command, for callers processing responses as they finish
+        :return: generator of tuples with url and its finished UrlFetchCommand, in finishing order
+        """
+        finished = deque()
+        futures = self._start(lambda index, url, cmd: finished.append((url, cmd)))
+        while finished or not all(future.done() for future in futures):
+            if not finished:
+                eventloop.run1()
+            while finished:
+                url, cmd = finished.popleft()
+                if cmd.errors:
+                    self.url_errors[url] = cmd.errors
+                yield url, cmd
+        for future in futures:
+            future.check_success()
+
 
 class TaskQueueCommand(Command):
     def __init__(self, queue_name, url, **kwargs):
@@ -59,10 +650,77 @@ class TaskQueueCommand(Command):
     def do_business(self, stop_on_error=False):
         self._rpc.get_result()
 
+    @ndb.tasklet
+    def do_business_async(self):
+        yield self._rpc
+
+
+class _PagePrefetcher(object):
+    """
+    Keeps up to lookahead pages being fetched ahead of the one returned to caller.
+    Next page query can only start when previous page's cursor is known, so each page query is started as soon as
+    previous one finishes, if window is not full, or as soon as caller consumes a page otherwise
+    """
+
+    def __init__(self, search, lookahead):
+        self._search = search
+        self._lookahead = lookahead
+        self._pages = deque()
+        self._next_cursor = None
+        self._start(search.start_cursor, search.offset)
+
+    def _start(self, cursor, offset):
+        self._next_cursor = None
+        self._pages.append(self._search._fetch_page_async(cursor, offset, self._on_page_keys))
+
+    def _on_page_keys(self, cursor, more):
+        if more and cursor:
+            self._next_cursor = cursor
+            self._fill_window()
+
+    def _fill_window(self):
+        if self._next_cursor is not None and len(self._pages) < self._lookahead:
+            self._start(self._next_cursor, 0)
+
+    def __iter__(self):
+        while self._pages:
+            page = self._pages[0].get_result()
+            self._pages.popleft()
+            self._fill_window()
+            yield page
+            if not self._pages and self._next_cursor is not None:
+                self._start(self._next_cursor, 0)
+
 
 class ModelSearchCommand(Command):
+    # Optional LRUCache kept in front of memcache. Pages invalidated by other instances are only discarded after its ttl
+    local_cache = None
+    # Seconds pages with no more results are kept on memcache, so entities added on listing end are seen.
+    # Full pages are kept until evicted or invalidated. Empty pages are never cached
+    tail_cache_time = 60
+    # Used when lock_on_miss is set: seconds a lease to recompute a page lasts and how searches not holding it wait
+    lease_time = 10
+    lease_poll_interval = 0.05
+    lease_polls = 20
+    # Used when soft_ttl is set: queue where tasks refreshing pages are added
+    refresh_queue = 'default'
+    # If False, writes made by commands don't invalidate cached pages, saving a memcache RPC on each execution.
+    # Pages of written kinds are then served stale until they expire or invalidate_search_cache is called
+    invalidate_on_write = True
+
     def __init__(self, query, page_size=100, start_cursor=None,
-                 offset=0, use_cache=True, cache_begin=True, **kwargs):
+                 offset=0, use_cache=True, cache_begin=True, projection=None, lock_on_miss=False, soft_ttl=None,
+                 **kwargs):
+        '''
+        :param projection: list of properties or properties names. If given, projected entities are fetched with a
+        single query, instead of a keys only query followed by a get of full entities
+        :param lock_on_miss: if True, only the search holding a memcache lease executes the query on a cache miss.
+        Others are served with page cached before last invalidation, if any, or poll for the fresh page
+        :param soft_ttl: seconds after which a cached page is still served, but a task is added to refresh it
+        '''
+        self.soft_ttl = soft_ttl
+        self.lock_on_miss = lock_on_miss
+        self.projection = tuple(getattr(p, '_name', p) for p in projection) if projection else None
         self.cache_begin = cache_begin
         self.use_cache = use_cache
         self.page_size = page_size
@@ -70,6 +728,7 @@ class ModelSearchCommand(Command):
         self.offset = offset
         self.__future = None
         self.__cached_keys = None
+        self.__local_generation = None
         self.cursor = None
         self.more = None
         if isinstance(start_cursor, basestring):
@@ -77,39 +736,256 @@ class ModelSearchCommand(Command):
         self.start_cursor = start_cursor
         super(ModelSearchCommand, self).__init__(**kwargs)
 
+    def _fingerprint_extra(self):
+        return {'projection': sorted(self.projection)} if self.projection else {}
+
     def _cache_key(self):
-        if self.start_cursor:
-            return '%s%s' % (self.offset, self.start_cursor.urlsafe())
+        return query_fingerprint(self.query, self.page_size, self.offset, self.start_cursor,
+                                 **self._fingerprint_extra())
+
+    def _lease_key(self, cache_key):
+        return str('%s:lease' % cache_key)
 
-        return '%s%s%s%s' % (self.query.kind,
-                             self.query.filters,
-                             self.query.orders,
-                             self.offset)
+    def _offset_cursors_key(self):
+        return query_fingerprint(self.query, mode='offset_cursors', **self._fingerprint_extra())
 
 
     def set_up(self):
+        # Cache lookups go through ndb context's auto batcher, so lookups started by all searches set up on the same
+        # CommandParallel are sent on a single memcache get_multi, before any query is executed
+        self.__future = self._search_async()
+
+    def _local_cache_get(self, cache_key):
+        if self.local_cache is not None:
+            local_tuple = self.local_cache.get(cache_key)
+            if local_tuple and local_tuple[1] == _local_generations.get(self.query.kind, 0):
+                return local_tuple[0]
+
+    def _read_local_generation(self):
+        # Read before page lookup or query, so pages invalidated while they are fetched are not stored as valid
+        self.__local_generation = _local_generations.get(self.query.kind, 0)
+
+    def _local_cache_set(self, cache_key, cached_tuple):
+        if self.local_cache is not None:
+            self.local_cache.set(cache_key, (cached_tuple, self.__local_generation))
+
+    @ndb.tasklet
+    def _cache_get_async(self, cache_key):
+        '''
+        :return: tuple with cached page, kind generation and page cached for a previous generation
+        '''
+        cached_tuple = self._local_cache_get(cache_key)
+        if cached_tuple:
+            raise ndb.Return(cached_tuple, cached_tuple[2], None)
+        context = ndb.get_context()
+        generation_key = _generation_key(self.query.kind)
+        try:
+            generation, cached_tuple = yield context.memcache_get(generation_key), context.memcache_get(cache_key)
+        except:
+            raise ndb.Return(None, None, None)
+        if generation is None:
+            # Adds from searches batched together are merged, so generation is read back to get the stored one
+            yield context.memcache_add(generation_key, _new_generation())
+            generation = yield context.memcache_get(generation_key)
+            raise ndb.Return(None, generation, cached_tuple)
+        if cached_tuple and cached_tuple[2] == generation:
+            self._local_cache_set(cache_key, cached_tuple)
+            raise ndb.Return(cached_tuple, generation, None)
+        raise ndb.Return(None, generation, cached_tuple)
+
+    def _is_soft_expired(self, cached_tuple):
+        return self.soft_ttl is not None and cached_tuple[4] + self.soft_ttl < time.time()
+
+    @ndb.tasklet
+    def _enqueue_refresh_async(self, cache_key, cached_tuple):
+        '''
+        Adds task refreshing page. Its name depends on page cache time, so only one task is added for each cached page
+        '''
+        try:
+            payload = deferred.serialize(refresh_search_page, _query_state(self.query), self.page_size,
+                                         self.start_cursor and self.start_cursor.urlsafe(), self.offset,
+                                         self.projection)
+        except pickle.PicklingError:
+            return
+        name = 'search-refresh-%s-%d' % (cache_key[len(FINGERPRINT_PREFIX):], cached_tuple[4] * 1000)
+        cmd = TaskQueueCommand(self.refresh_queue, DEFERRED_URL, payload=payload, name=name,
+                               headers={'Content-Type': 'application/octet-stream'})
+        cmd.set_up()
+        try:
+            yield cmd._rpc
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+    @ndb.tasklet
+    def _refresh_async(self):
+        self._read_local_generation()
+        cache_key = self._cache_key()
+        generation = yield ndb.get_context().memcache_get(_generation_key(self.query.kind))
+        if generation is not None:
+            yield self._query_async(cache_key, generation)
+
+    def _cache_set_async(self, cache_key, cached_tuple):
+        self._local_cache_set(cache_key, cached_tuple)
+        time = 0 if cached_tuple[3] else self.tail_cache_time
+        return ndb.get_context().memcache_set(cache_key, cached_tuple, time=time)
+
+    @ndb.tasklet
+    def _wait_lease_async(self, cache_key, generation):
+        '''
+        Polls memcache while other search holds the lease to recompute page
+        :return: fresh cached page or None if lease was released or expired without caching it
+        '''
+        context = ndb.get_context()
+        lease_key = self._lease_key(cache_key)
+        for _ in xrange(self.lease_polls):
+            yield ndb.sleep(self.lease_poll_interval)
+            cached_tuple, lease = yield context.memcache_get(cache_key), context.memcache_get(lease_key)
+            if cached_tuple and cached_tuple[2] == generation:
+                self._local_cache_set(cache_key, cached_tuple)
+                raise ndb.Return(cached_tuple)
+            if lease is None:
+                break
+
+    @ndb.tasklet
+    def _cached_models_async(self, cached_tuple):
+        self.cursor, self.more = cached_tuple[1], cached_tuple[3]
+        if self.projection:
+            raise ndb.Return([_decode_projected(encoded, self.projection) for encoded in cached_tuple[0]])
+        self.__cached_keys = cached_tuple[0]
+        models = yield ndb.get_multi_async(self.__cached_keys)
+        raise ndb.Return(models)
+
+    def _should_translate_offset(self):
+        return self.use_cache and self.start_cursor is None and self.offset > 0
+
+    @ndb.tasklet
+    def _offset_cursors_get_async(self, offset_cursors_key):
+        '''
+        :return: tuple with kind generation and dict mapping offsets to cursors reached on them
+        '''
+        context = ndb.get_context()
+        try:
+            generation, cached = yield (context.memcache_get(_generation_key(self.query.kind)),
+                                        context.memcache_get(offset_cursors_key))
+        except:
+            raise ndb.Return(None, {})
+        if generation is not None and cached and cached[0] == generation:
+            raise ndb.Return(generation, cached[1])
+        raise ndb.Return(generation, {})
+
+    def _offset_cursors_set_async(self, offset_cursors_key, generation, offset_cursors):
+        # Concurrent searches may overwrite each other boundaries, which are recorded again on next misses
+        if len(offset_cursors) > OFFSET_CURSORS_LIMIT:
+            offset_cursors = dict((o, offset_cursors[o]) for o in sorted(offset_cursors)[-OFFSET_CURSORS_LIMIT:])
+        return ndb.get_context().memcache_set(offset_cursors_key, (generation, offset_cursors))
+
+    def _translate_offset(self, offset_cursors):
+        '''
+        :return: tuple with cursor and offset to be used on query, starting on nearest known boundary before offset
+        '''
+        boundary = max([o for o in offset_cursors if o <= self.offset] or [0])
+        if boundary:
+            return Cursor(urlsafe=offset_cursors[boundary]), self.offset - boundary
+        return self.start_cursor, self.offset
+
+    @ndb.tasklet
+    def _query_async(self, cache_key, generation, offset_cursors_key=None, offset_cursors_future=None):
+        start_cursor, offset = self.start_cursor, self.offset
+        if offset_cursors_future:
+            offsets_generation, offset_cursors = yield offset_cursors_future
+            start_cursor, offset = self._translate_offset(offset_cursors)
+        if self.projection:
+            models, self.cursor, self.more = yield self.query.fetch_page_async(self.page_size,
+                                                                               start_cursor=start_cursor,
+                                                                               offset=offset,
+                                                                               projection=self.projection)
+            page, futures = [_encode_projected(m) for m in models], []
+        else:
+            page, self.cursor, self.more = yield self.query.fetch_page_async(self.page_size,
+                                                                             start_cursor=start_cursor,
+                                                                             offset=offset,
+                                                                             keys_only=True)
+            futures = ndb.get_multi_async(page)
+        # Page and reached boundary are set together, so they go on the same memcache set_multi
+        sets = []
+        if cache_key and page:
+            sets.append(self._cache_set_async(cache_key, (page, self.cursor, generation, self.more, time.time())))
+        if offset_cursors_future and offsets_generation is not None and page and self.cursor:
+            offset_cursors[self.offset + len(page)] = self.cursor.urlsafe()
+            sets.append(self._offset_cursors_set_async(offset_cursors_key, offsets_generation, offset_cursors))
+        results = yield futures + sets
+        if not self.projection:
+            models = results[:len(page)]
+        raise ndb.Return(models)
+
+    @ndb.tasklet
+    def _search_async(self):
+        self._read_local_generation()
+        cache_key = generation = offset_cursors_key = offset_cursors_future = lease_key = None
+        if self._should_translate_offset():
+            # Started before page lookup, so both are sent on the same memcache get_multi
+            offset_cursors_key = self._offset_cursors_key()
+            offset_cursors_future = self._offset_cursors_get_async(offset_cursors_key)
         if self._should_cache():
-            try:
-                cached_tuple = memcache.get(self._cache_key())
-                if cached_tuple:
-                    self.__cached_keys, self.cursor, self.more = cached_tuple[0], cached_tuple[1], True
-            except:
-                pass
-        if not self.__cached_keys:
-            self.__future = self.query.fetch_page_async(self.page_size,
-                                                        start_cursor=self.start_cursor,
-                                                        offset=self.offset,
-                                                        keys_only=True)
+            cache_key = self._cache_key()
+            cached_tuple, generation, stale_tuple = yield self._cache_get_async(cache_key)
+            if cached_tuple:
+                futures = [self._cached_models_async(cached_tuple)]
+                if self._is_soft_expired(cached_tuple):
+                    futures.append(self._enqueue_refresh_async(cache_key, cached_tuple))
+                results = yield futures
+                raise ndb.Return(results[0])
+            if self.lock_on_miss and generation is not None:
+                lease_key = self._lease_key(cache_key)
+                if not (yield ndb.get_context().memcache_add(lease_key, True, time=self.lease_time)):
+                    lease_key = None
+                    cached_tuple = stale_tuple or (yield self._wait_lease_async(cache_key, generation))
+                    if cached_tuple:
+                        models = yield self._cached_models_async(cached_tuple)
+                        raise ndb.Return(models)
+        try:
+            models = yield self._query_async(cache_key, generation, offset_cursors_key, offset_cursors_future)
+        finally:
+            # Released even if query fails, so other searches don't wait until lease expires
+            if lease_key:
+                yield ndb.get_context().memcache_delete(lease_key)
+        raise ndb.Return(models)
 
     def do_business(self, stop_on_error=True):
-        if self.__future:
-            model_keys, self.cursor, self.more = self.__future.get_result()
-            future = ndb.get_multi_async(model_keys)
-            if self._should_cache() and len(model_keys) == self.page_size:
-                memcache.set(self._cache_key(), (model_keys, self.cursor))
-            self.result = [f.get_result() for f in future]
-        else:
-            self.result = ndb.get_multi(self.__cached_keys)
+        self.result = self.__future.get_result()
+
+    @ndb.tasklet
+    def do_business_async(self):
+        yield self.__future
+        self.do_business()
+
+    @ndb.tasklet
+    def _fetch_page_async(self, start_cursor, offset, keys_callback):
+        if self.projection:
+            models, cursor, more = yield self.query.fetch_page_async(self.page_size,
+                                                                     start_cursor=start_cursor,
+                                                                     offset=offset,
+                                                                     projection=self.projection)
+            keys_callback(cursor, more)
+            raise ndb.Return(models, cursor, more)
+        model_keys, cursor, more = yield self.query.fetch_page_async(self.page_size,
+                                                                     start_cursor=start_cursor,
+                                                                     offset=offset,
+                                                                     keys_only=True)
+        keys_callback(cursor, more)
+        models = yield ndb.get_multi_async(model_keys)
+        raise ndb.Return(models, cursor, more)
+
+    def iter_pages(self, lookahead=1):
+        """
+        Generator walking through all pages from start_cursor and offset, without using cache.
+        While caller processes a page, next pages up to lookahead are already being fetched, so at most
+        lookahead + 1 pages are held in memory. cursor and more are updated for each page
+        :param lookahead: number of pages fetched ahead of the current one
+        :return: generator of lists of models, one for each page
+        """
+        for models, self.cursor, self.more in _PagePrefetcher(self, lookahead):
+            yield models
 
     def _should_cache(self):
         return self.use_cache and (self.start_cursor or self.cache_begin)
@@ -139,8 +1015,18 @@ class NaiveSaveCommand(Command):
     def do_business(self, stop_on_error=True):
         self.__future.get_result()
 
+    @ndb.tasklet
+    def do_business_async(self):
+        yield self.__future
+        self.do_business()
+
+    def written_kinds(self):
+        return _kinds(self.result)
+
 
 class NaiveUpdateCommand(Command):
+    _independent_set_up = True
+
     def __init__(self, model_class, id_or_key, model_properties=None):
         super(NaiveUpdateCommand, self).__init__()
         self.key = id_or_key if isinstance(id_or_key, ndb.Key) else ndb.Key(model_class, int(id_or_key))
@@ -158,6 +1044,14 @@ class NaiveUpdateCommand(Command):
         self.result = model
         self._to_commit = model
 
+    @ndb.tasklet
+    def do_business_async(self):
+        yield self.__future
+        self.do_business()
+
+    def written_kinds(self):
+        return _kinds(self._to_commit)
+
 
 class NaiveFindOrCreateModelCommand(SingleModelSearchCommand):
     def __init__(self, query, model_class, model_properties=None, start_cursor=None, offset=0, use_cache=True):
@@ -172,6 +1066,9 @@ class NaiveFindOrCreateModelCommand(SingleModelSearchCommand):
             self.result = model
             self._to_commit = model
 
+    def written_kinds(self):
+        return _kinds(self._to_commit)
+
 
 class SaveCommand(Command):
     _model_form_class = None
@@ -188,8 +1085,13 @@ class SaveCommand(Command):
             self.result = self.form.fill_model()
             self._to_commit = self.result
 
+    def written_kinds(self):
+        return _kinds(self._to_commit)
+
 
 class UpdateCommand(SaveCommand):
+    _independent_set_up = True
+
     def __init__(self, model_or_key, **form_parameters):
         super(UpdateCommand, self).__init__(**form_parameters)
         self.__model = None
@@ -215,6 +1117,12 @@ class UpdateCommand(SaveCommand):
             self.form.fill_model(model)
             self._to_commit = model
 
+    @ndb.tasklet
+    def do_business_async(self):
+        if self._model_future is not None:
+            yield self._model_future
+        self.do_business()
+
 
 class FindOrCreateCommand(SingleModelSearchCommand):
     _model_form_class = None
@@ -233,6 +1141,9 @@ class FindOrCreateCommand(SingleModelSearchCommand):
                 self.result = self.form.fill_model()
                 self._to_commit = self.result
 
+    def written_kinds(self):
+        return _kinds(self._to_commit)
+
 
 class DeleteCommand(Command):
     def __init__(self, *model_keys):
@@ -240,4 +1151,7 @@ class DeleteCommand(Command):
         self.model_keys = model_keys
 
     def commit(self):
-        ndb.delete_multi(self.model_keys)
\ No newline at end of file
+        ndb.delete_multi(self.model_keys)
+
+    def written_kinds(self):
+        return _kinds(list(self.model_keys))
\ No newline at end of file
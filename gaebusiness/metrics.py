@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from bisect import bisect_left
+import json
+import threading
+from google.appengine.api import apiproxy_stub_map
+from gaebusiness import tracing
+
+# Upper bounds, in milliseconds, of histograms buckets. Last bucket holds greater durations
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+PERCENTILES = (50, 95, 99)
+
+# Registries counting RPCs
+_installed = []
+
+
+def _count_rpc(service, call, request, response):
+    for registry in _installed:
+        registry.count_rpc(service)
+
+
+class Histogram(object):
+    """
+    Fixed buckets histogram. Percentiles are estimated as the upper bound of the bucket where they fall
+    """
+
+    def __init__(self, buckets=BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value, error=False):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if error:
+            self.errors += 1
+
+    def percentile(self, percent):
+        """
+        :param percent: number between 0 and 100
+        :return: estimated value or None if nothing was observed
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        accumulated = 0
+        for bound, count in zip(self.buckets, self.counts):
+            accumulated += count
+            if accumulated >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        summary = {'count': self.count,
+                   'errors': self.errors,
+                   'mean_ms': round(self.total / self.count, 3) if self.count else None,
+                   'max_ms': round(self.max, 3)}
+        for percent in PERCENTILES:
+            summary['p%s_ms' % percent] = self.percentile(percent)
+        return summary
+
+
+class MetricsRegistry(object):
+    """
+    Aggregates latency and RPCs of commands' phases, by command class and phase, and RPCs counts by service for all
+    requests served by the instance. RPCs of a phase include the ones made by its nested commands. Ex:
+
+        registry = MetricsRegistry()
+        registry.install()
+
+    And on a handler:
+
+        self.response.write(registry.to_json())
+    """
+
+    def __init__(self, buckets=BUCKETS_MS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.phase_rpcs = {}
+        self.rpc_counts = {}
+        self._lock = threading.Lock()
+
+    def install(self):
+        """
+        Starts observing commands' phases and RPCs made through current apiproxy
+        """
+        tracing.install_rpc_counter()
+        tracing.add_observer(self.observe)
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('gaebusiness_metrics', _count_rpc)
+        if self not in _installed:
+            _installed.append(self)
+
+    def uninstall(self):
+        tracing.remove_observer(self.observe)
+        if self in _installed:
+            _installed.remove(self)
+
+    def observe(self, command_class, phase, duration, error=None, rpcs=0):
+        key = (command_class, phase)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(duration * 1000, error is not None)
+            self.phase_rpcs[key] = self.phase_rpcs.get(key, 0) + rpcs
+
+    def count_rpc(self, service):
+        with self._lock:
+            self.rpc_counts[service] = self.rpc_counts.get(service, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.phase_rpcs = {}
+            self.rpc_counts = {}
+
+    def to_dict(self):
+        with self._lock:
+            commands = {}
+            for (command_class, phase), histogram in self.histograms.iteritems():
+                summary = histogram.to_dict()
+                summary['rpcs'] = self.phase_rpcs[(command_class, phase)]
+                summary['mean_rpcs'] = round(summary['rpcs'] / float(histogram.count), 3)
+                commands.setdefault(command_class, {})[phase] = summary
+            return {'commands': commands, 'rpcs': dict(self.rpc_counts)}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+    def to_text(self):
+        """
+        :return: one line for each command class and phase, sorted by them, followed by RPCs counts
+        """
+        metrics = self.to_dict()
+        lines = []
+        for command_class in sorted(metrics['commands']):
+            for phase, summary in sorted(metrics['commands'][command_class].iteritems()):
+                lines.append('%s.%s count=%s errors=%s mean=%sms p50=%sms p95=%sms p99=%sms max=%sms rpcs=%s '
+                             'mean_rpcs=%s' % (command_class, phase, summary['count'], summary['errors'],
+                                               summary['mean_ms'], summary['p50_ms'], summary['p95_ms'],
+                                               summary['p99_ms'], summary['max_ms'], summary['rpcs'],
+                                               summary['mean_rpcs']))
+        for service, count in sorted(metrics['rpcs'].iteritems()):
+            lines.append('rpcs.%s %s' % (service, count))
+        return '\n'.join(lines)
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import json
+import logging
+import threading
+import time
+from google.appengine.api import apiproxy_stub_map
+
+_local = threading.local()
+
+# Callables notified of every traced phase, even without an active Tracer
+_observers = []
+
+
+def rpc_counts():
+    """
+    :return: dict with the number of RPCs started on current thread by service, since tracing was first enabled
+    """
+    try:
+        return _local.rpc_counts
+    except AttributeError:
+        _local.rpc_counts = {}
+        return _local.rpc_counts
+
+
+def rpc_count():
+    return sum(rpc_counts().itervalues())
+
+
+def _count_rpc(service, call, request, response):
+    counts = rpc_counts()
+    counts[service] = counts.get(service, 0) + 1
+
+
+def install_rpc_counter():
+    """
+    Registers the hook counting RPCs on current apiproxy. Registering more than once has no effect
+    """
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('gaebusiness_rpc_counter', _count_rpc)
+
+
+class Span(object):
+    """
+    Time spent by a command on a phase of its execution. Spans of nested commands are its children
+    """
+
+    def __init__(self, command, phase):
+        self.command_class = command.__class__.__name__
+        self.phase = phase
+        self.children = []
+        self.error = None
+        self.duration = None
+        self.rpcs = None
+        self._rpcs_on_start = rpc_count()
+        self.started = time.time()
+
+    def finish(self, error=None):
+        self.duration = time.time() - self.started
+        self.rpcs = rpc_count() - self._rpcs_on_start
+        self.error = error
+
+    def to_dict(self):
+        return {'command': self.command_class,
+                'phase': self.phase,
+                'duration_ms': round(self.duration * 1000, 3),
+                'rpcs': self.rpcs,
+                'error': self.error,
+                'children': [child.to_dict() for child in self.children]}
+
+
+def log_sink(span, level=logging.INFO, depth=0):
+    """
+    Logs span tree, one line per span indented by depth
+    """
+    error = ' error=%s' % span.error if span.error else ''
+    logging.log(level, '%s%s.%s %.3fms rpcs=%s%s', '  ' * depth, span.command_class, span.phase,
+                span.duration * 1000, span.rpcs, error)
+    for child in span.children:
+        log_sink(child, level, depth + 1)
+
+
+def json_sink(span):
+    """
+    Logs span tree as a JSON document
+    """
+    logging.info(json.dumps(span.to_dict()))
+
+
+class Tracer(object):
+    """
+    Records spans for commands executed while it is active. Ex:
+
+        with Tracer(json_sink):
+            CommandParallel(cmd1, cmd2).execute()
+
+    When it is deactivated each root span is passed to sink, which is any callable receiving a Span
+    """
+
+    def __init__(self, sink=log_sink):
+        self.sink = sink
+        self.spans = []
+        self._open_spans = []
+        self._previous = None
+
+    def __enter__(self):
+        install_rpc_counter()
+        self._previous = getattr(_local, 'tracer', None)
+        _local.tracer = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _local.tracer = self._previous
+        for span in self.spans:
+            self.sink(span)
+        return False
+
+    def open_span(self, command, phase):
+        span = Span(command, phase)
+        if self._open_spans:
+            self._open_spans[-1].children.append(span)
+        else:
+            self.spans.append(span)
+        self._open_spans.append(span)
+        return span
+
+    def close_span(self, span, error=None):
+        span.finish(error)
+        self._open_spans.pop()
+
+
+def add_observer(observer):
+    """
+    Registers a callable notified when any command's phase finishes, on any thread.
+    RPCs are counted only after install_rpc_counter is called, and include the ones made by nested commands
+    :param observer: callable receiving command class name, phase, duration in seconds, error class name or None and
+    number of RPCs started during phase
+    """
+    if observer not in _observers:
+        _observers.append(observer)
+
+
+def remove_observer(observer):
+    if observer in _observers:
+        _observers.remove(observer)
+
+
+class _SpanContext(object):
+    def __init__(self, tracer, command, phase):
+        self._tracer = tracer
+        self._command = command
+        self._phase = phase
+        self._span = None
+
+    def __enter__(self):
+        self._span = self._tracer.open_span(self._command, self._phase)
+        return self._span
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        error = exc_type and exc_type.__name__
+        self._tracer.close_span(self._span, error)
+        for observer in _observers:
+            observer(self._span.command_class, self._phase, self._span.duration, error, self._span.rpcs)
+        return False
+
+
+class _ObserverContext(object):
+    """
+    Context notifying observers when there is no active Tracer. Only one is created for each thread and reused by all
+    phases, which are nested, so observing phases allocates no context per call
+    """
+
+    def __init__(self):
+        self._phases = []
+
+    def push(self, command, phase):
+        self._phases.append((command, phase, time.time(), rpc_count()))
+        return self
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        command, phase, started, rpcs_on_start = self._phases.pop()
+        duration = time.time() - started
+        rpcs = rpc_count() - rpcs_on_start
+        error = exc_type and exc_type.__name__
+        command_class = command.__class__.__name__
+        for observer in _observers:
+            observer(command_class, phase, duration, error, rpcs)
+        return False
+
+
+def _observer_context():
+    try:
+        return _local.observer_context
+    except AttributeError:
+        _local.observer_context = _ObserverContext()
+        return _local.observer_context
+
+
+class _NoSpanContext(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NO_SPAN = _NoSpanContext()
+
+
+def trace(command, phase):
+    """
+    :return: context manager recording a span for command's phase if there is an active Tracer on current thread,
+    and notifying observers
+    """
+    tracer = getattr(_local, 'tracer', None)
+    if tracer is not None:
+        return _SpanContext(tracer, command, phase)
+    if _observers:
+        return _observer_context().push(command, phase)
+    return _NO_SPAN
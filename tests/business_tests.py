@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 from itertools import izip
+import time
 import unittest
 from google.appengine.ext import ndb
-from gaebusiness.business import Command, CommandParallel, CommandExecutionException, CommandSequential, CommandListBase
+from gaebusiness.business import Command, CommandParallel, CommandExecutionException, CommandSequential, CommandListBase, \
+    put_models_async, CommandGraph, add_write_observer, remove_write_observer
 from gaebusiness.gaeutil import DeleteCommand
 from gaeutil_tests import ModelStub
 from mock import Mock
@@ -194,6 +196,23 @@ class CommandParallelTests(CommandBaseListTest):
             self.assert_command_only_commit_not_executed(cmd, m)
         self.assertDictEqual({ANOTHER_ERROR_KEY: ANOTHER_ERROR_MSG, ERROR_KEY: ERROR_MSG}, command_list.errors)
 
+    def _fail_fast_parallel(self):
+        return CommandParallel(CommandMock("mock 0"), CommandMock("mock 1", ERROR_KEY, ERROR_MSG),
+                               CommandMock("mock 2", ANOTHER_ERROR_KEY, ANOTHER_ERROR_MSG), fail_fast=True)
+
+    def test_fail_fast(self):
+        command_list = self._fail_fast_parallel()
+        self.assertRaises(CommandExecutionException, command_list.execute)
+        self.assertDictEqual({ERROR_KEY: ERROR_MSG}, command_list.errors)
+        self.assert_command_only_commit_not_executed(command_list[0], "mock 0")
+        self.assert_command_only_commit_not_executed(command_list[1], "mock 1")
+        self.assert_command_only_setup_executed(command_list[2])
+
+    def test_fail_fast_async(self):
+        command_list = self._fail_fast_parallel()
+        self.assertRaises(CommandExecutionException, command_list.execute_async().get_result)
+        self.assertDictEqual({ERROR_KEY: ERROR_MSG}, command_list.errors)
+        self.assertEqual(0, ModelMock.query().count())
 
     def test_commit(self):
         class CommadParallelMock(CommandParallel):
@@ -270,6 +289,217 @@ class CommandSequentialTests(CommandBaseListTest):
         cmd()
         self.assertIsNotNone(ModelMock.query().get())
 
+    def test_unit_of_work(self):
+        class HandlePreviousMock(CommandMock):
+            def handle_previous(self, command):
+                self.previous_ppt = command.result.ppt
+                self.previous_key = command.result.key
+
+        mock_1 = CommandMock('mock 1')
+        mock_2 = HandlePreviousMock('mock 2')
+        command_list = CommandSequential(mock_1, mock_2, unit_of_work=True)
+        command_list.execute()
+        self.assertEqual('mock 1', mock_2.previous_ppt)
+        self.assertIsNone(mock_2.previous_key, 'previous model should be saved only at the end of sequence')
+        self.assert_command_executed(mock_1, 'mock 1')
+        self.assert_command_executed(mock_2, 'mock 2')
+
+    def test_unit_of_work_with_error(self):
+        command_list = CommandSequential(CommandMock('mock 0'), CommandMock('mock 1', ERROR_KEY, ERROR_MSG),
+                                         CommandMock('mock 2'), unit_of_work=True)
+        self.assertRaises(CommandExecutionException, command_list.execute)
+        self.assertIsNone(command_list[0].result.key, 'nothing should be saved when a command fails')
+        self.assert_command_only_commit_not_executed(command_list[1], 'mock 1')
+        self.assert_command_not_executed(command_list[2])
+        self.assertDictEqual({ERROR_KEY: ERROR_MSG}, command_list.errors)
+        self.assertIsNone(ModelMock.query().get())
+
+
+class DelayCommand(CommandMock):
+    def __init__(self, model_ppt, seconds):
+        super(DelayCommand, self).__init__(model_ppt)
+        self.seconds = seconds
+        self._future = None
+
+    def set_up(self):
+        super(DelayCommand, self).set_up()
+        self._future = ndb.sleep(self.seconds)
+
+    def do_business(self, stop_on_error=False):
+        self._future.get_result()
+        super(DelayCommand, self).do_business(stop_on_error)
+
+    @ndb.tasklet
+    def do_business_async(self):
+        yield self._future
+        self.do_business()
+
+
+class CommandGraphTests(CommandBaseListTest):
+    def test_empty(self):
+        CommandGraph()()
+
+    def _slow_and_fast_branches(self):
+        graph = CommandGraph()
+        graph.add(DelayCommand('slow', 0.3))
+        fast = graph.add(DelayCommand('fast', 0.01))
+        graph.add(DelayCommand('after fast', 0.3), fast)
+        return graph
+
+    def test_dependents_not_waiting_other_branches(self):
+        for execute in (lambda graph: graph.execute(), lambda graph: graph.execute_async().get_result()):
+            graph = self._slow_and_fast_branches()
+            begin = time.time()
+            execute(graph)
+            self.assertLess(time.time() - begin, 0.5, 'graph should take as long as its slowest path')
+            for cmd in graph:
+                self.assert_command_executed(cmd, cmd._model_ppt)
+
+    def test_execute_successful_business(self):
+        calls = []
+
+        class CallsMock(CommandMock):
+            def set_up(self):
+                super(CallsMock, self).set_up()
+                calls.append(('set_up', self._model_ppt))
+
+            def do_business(self, stop_on_error=False):
+                super(CallsMock, self).do_business(stop_on_error)
+                calls.append(('do_business', self._model_ppt))
+
+            def handle_previous(self, command):
+                calls.append(('handle_previous', self._model_ppt, command._model_ppt))
+
+        graph = CommandGraph()
+        a = graph.add(CallsMock('a'))
+        b = graph.add(CallsMock('b'))
+        c = graph.add(CallsMock('c'), a, b)
+        d = graph.add(CallsMock('d'), a)
+        result = graph()
+        self.assertListEqual([('set_up', 'a'), ('set_up', 'b'),
+                              ('do_business', 'a'), ('do_business', 'b'),
+                              ('handle_previous', 'd', 'a'), ('set_up', 'd'), ('do_business', 'd'),
+                              ('handle_previous', 'c', 'a'), ('handle_previous', 'c', 'b'), ('set_up', 'c'),
+                              ('do_business', 'c')], calls)
+        for cmd, ppt in izip([a, b, c, d], 'abcd'):
+            self.assert_command_executed(cmd, ppt)
+        self.assertEqual(c.result, result, 'result must be equals to last command result on topological order')
+
+    def test_execute_with_error(self):
+        graph = CommandGraph()
+        a = graph.add(CommandMock('a'))
+        b = graph.add(CommandMock('b', ERROR_KEY, ERROR_MSG), a)
+        c = graph.add(CommandMock('c'), b)
+        self.assertRaises(CommandExecutionException, graph.execute)
+        self.assert_command_only_commit_not_executed(a, 'a')
+        self.assert_command_only_commit_not_executed(b, 'b')
+        self.assert_command_not_executed(c)
+        self.assertDictEqual({ERROR_KEY: ERROR_MSG}, graph.errors)
+
+    def test_error_stops_other_branches(self):
+        graph = CommandGraph()
+        graph.add(CommandMock('a', ERROR_KEY, ERROR_MSG))
+        b = graph.add(DelayCommand('b', 0.01))
+        c = graph.add(CommandMock('c'), b)
+        self.assertRaises(CommandExecutionException, graph.execute)
+        self.assert_command_not_executed(c)
+        self.assertDictEqual({ERROR_KEY: ERROR_MSG}, graph.errors)
+
+    def test_cycle(self):
+        graph = CommandGraph()
+        a = Command()
+        b = graph.add(Command(), a)
+        graph.add(a, b)
+        self.assertRaises(Exception, graph.execute)
+
+    def test_dependency_not_on_graph(self):
+        graph = CommandGraph()
+        graph.add(Command(), Command())
+        self.assertRaises(Exception, graph.execute)
+
+
+class PostCommitMock(CommandMock):
+    def __init__(self, model_ppt):
+        super(PostCommitMock, self).__init__(model_ppt)
+        self.post_commit_keys = []
+
+    def post_commit(self):
+        self.post_commit_keys.append(self.result.key)
+        future = ndb.Future()
+        future.set_result(None)
+        return future
+
+
+class PostCommitTests(GAETestCase):
+    def test_command(self):
+        cmd = PostCommitMock('foo')
+        cmd()
+        self.assertListEqual([cmd.result.key], cmd.post_commit_keys)
+        self.assertIsNotNone(cmd.result.key)
+
+    def test_parallel(self):
+        cmds = [PostCommitMock('foo'), PostCommitMock('bar')]
+        CommandParallel(*cmds)()
+        for cmd in cmds:
+            self.assertListEqual([cmd.result.key], cmd.post_commit_keys)
+            self.assertIsNotNone(cmd.result.key)
+
+    def test_sequential(self):
+        for unit_of_work in (False, True):
+            cmds = [PostCommitMock('foo'), PostCommitMock('bar')]
+            CommandSequential(*cmds, unit_of_work=unit_of_work)()
+            for cmd in cmds:
+                self.assertListEqual([cmd.result.key], cmd.post_commit_keys)
+                self.assertIsNotNone(cmd.result.key)
+
+    def test_not_called_on_error(self):
+        cmd = PostCommitMock('foo')
+        parallel = CommandParallel(cmd, CommandMock('bar', ERROR_KEY, ERROR_MSG))
+        self.assertRaises(CommandExecutionException, parallel)
+        self.assertListEqual([], cmd.post_commit_keys)
+
+
+class WriteMock(CommandMock):
+    def written_kinds(self):
+        return {self._model_ppt}
+
+
+class WriteObserverTests(GAETestCase):
+    def setUp(self):
+        super(WriteObserverTests, self).setUp()
+        self.written = []
+        add_write_observer(self.written.append)
+
+    def tearDown(self):
+        remove_write_observer(self.written.append)
+        super(WriteObserverTests, self).tearDown()
+
+    def test_command(self):
+        WriteMock('foo')()
+        self.assertListEqual([{'foo'}], self.written)
+
+    def test_notified_once_by_containers(self):
+        for container in (CommandParallel, CommandGraph,
+                          lambda *cmds: CommandSequential(*cmds, unit_of_work=True)):
+            self.written = []
+            remove_write_observer(self.written.append)
+            add_write_observer(self.written.append)
+            container(WriteMock('foo'), WriteMock('foo'), CommandParallel(WriteMock('bar')), Command())()
+            self.assertListEqual([{'foo', 'bar'}], self.written)
+
+    def test_sequence_notifies_each_execution(self):
+        CommandSequential(WriteMock('foo'), CommandParallel(WriteMock('foo'), WriteMock('bar')))()
+        self.assertListEqual([{'foo'}, {'foo', 'bar'}], self.written)
+
+    def test_async(self):
+        CommandParallel(WriteMock('foo'), WriteMock('bar')).execute_async().get_result()
+        self.assertListEqual([{'foo', 'bar'}], self.written)
+
+    def test_not_notified_on_error(self):
+        self.assertRaises(CommandExecutionException,
+                          CommandParallel(WriteMock('foo'), CommandMock('bar', ERROR_KEY, ERROR_MSG)))
+        self.assertListEqual([], self.written)
+
 
 def cmd_with_handle_previous_mocked():
     c = Command()
@@ -328,6 +558,121 @@ class HandlePreviousTests(unittest.TestCase):
         self.assert_handle_previous_not_called(cmd)
 
 
+class SleepCommand(CommandMock):
+    def __init__(self, model_ppt, log):
+        super(SleepCommand, self).__init__(model_ppt)
+        self.log = log
+
+    @ndb.tasklet
+    def do_business_async(self):
+        self.log.append(('begin', self._model_ppt))
+        yield ndb.sleep(0)
+        self.log.append(('end', self._model_ppt))
+        self.do_business()
+
+
+class ExecuteAsyncTests(GAETestCase):
+    def test_command(self):
+        future = CommandMock('foo').execute_async()
+        self.assertIsInstance(future, ndb.Future)
+        cmd = future.get_result()
+        self.assertEqual('foo', cmd.result.key.get().ppt)
+
+    def test_error(self):
+        cmd = CommandMock('foo', ERROR_KEY, ERROR_MSG)
+        self.assertRaises(CommandExecutionException, cmd.execute_async().get_result)
+        self.assertFalse(cmd.commit_executed)
+        self.assertEqual(0, ModelMock.query().count())
+
+    def test_containers(self):
+        for container in (CommandParallel(CommandMock('foo'), CommandMock('bar')),
+                          CommandSequential(CommandMock('foo'), CommandMock('bar')),
+                          CommandSequential(CommandMock('foo'), CommandMock('bar'), unit_of_work=True),
+                          CommandGraph(CommandMock('foo'), CommandMock('bar'))):
+            self.assertEqual('bar', container.execute_async().get_result().result.ppt)
+            self.assertTrue(all(cmd.result.key.get() for cmd in container))
+
+    def test_containers_errors(self):
+        for container_class in (CommandParallel, CommandSequential, CommandGraph):
+            container = container_class(CommandMock('foo', ERROR_KEY, ERROR_MSG), CommandMock('bar'))
+            self.assertRaises(CommandExecutionException, container.execute_async().get_result)
+            self.assertDictEqual({ERROR_KEY: ERROR_MSG}, container.errors)
+        self.assertEqual(0, ModelMock.query().count())
+
+    def test_interleaving(self):
+        log = []
+
+        @ndb.tasklet
+        def execute_both():
+            cmds = yield SleepCommand('foo', log).execute_async(), SleepCommand('bar', log).execute_async()
+            raise ndb.Return([cmd.result.ppt for cmd in cmds])
+
+        self.assertListEqual(['foo', 'bar'], execute_both().get_result())
+        self.assertListEqual([('begin', 'foo'), ('begin', 'bar'), ('end', 'foo'), ('end', 'bar')], log)
+
+    def test_parallel_interleaving(self):
+        log = []
+        CommandParallel(SleepCommand('foo', log), SleepCommand('bar', log)).execute_async().get_result()
+        self.assertListEqual([('begin', 'foo'), ('begin', 'bar'), ('end', 'foo'), ('end', 'bar')], log)
+
+
+class LogCommand(CommandMock):
+    def __init__(self, model_ppt, log):
+        super(LogCommand, self).__init__(model_ppt)
+        self.log = log
+
+    def set_up(self):
+        super(LogCommand, self).set_up()
+        self.log.append(('set_up', self._model_ppt))
+
+    def do_business(self, stop_on_error=False):
+        super(LogCommand, self).do_business(stop_on_error)
+        self.log.append(('do_business', self._model_ppt))
+
+
+class IndependentLogCommand(LogCommand):
+    _independent_set_up = True
+
+
+class PipelineTests(GAETestCase):
+    def _sequence(self, log, **kwargs):
+        return CommandSequential(LogCommand('foo', log), IndependentLogCommand('bar', log),
+                                 IndependentLogCommand('baz', log), **kwargs)
+
+    def test_pipeline(self):
+        for unit_of_work in (False, True):
+            log = []
+            sequence = self._sequence(log, pipeline=True, unit_of_work=unit_of_work)
+            self.assertEqual('baz', sequence().ppt)
+            self.assertListEqual([('set_up', 'bar'), ('set_up', 'baz'),
+                                  ('set_up', 'foo'), ('do_business', 'foo'),
+                                  ('do_business', 'bar'), ('do_business', 'baz')], log)
+            self.assertTrue(all(cmd.result.key.get() for cmd in sequence))
+
+    def test_pipeline_async(self):
+        log = []
+        self._sequence(log, pipeline=True).execute_async().get_result()
+        self.assertListEqual([('set_up', 'bar'), ('set_up', 'baz')], log[:2])
+        self.assertEqual(3, ModelMock.query().count())
+
+    def test_without_pipeline(self):
+        log = []
+        self._sequence(log)()
+        self.assertListEqual([('set_up', 'foo'), ('do_business', 'foo'),
+                              ('set_up', 'bar'), ('do_business', 'bar'),
+                              ('set_up', 'baz'), ('do_business', 'baz')], log)
+
+
+class PutModelsTests(GAETestCase):
+    def test_chunks(self):
+        models = [ModelMock(ppt=str(i)) for i in xrange(5)]
+        futures = put_models_async(models, chunk_size=2)
+        self.assertEqual(5, len(futures))
+        keys = [f.get_result() for f in futures]
+        self.assertListEqual(keys, [m.key for m in models])
+        self.assertListEqual(models, ndb.get_multi(keys))
+
+
 class DeleteCommnadTests(GAETestCase):
     def test_delete(self):
         model = mommy.save_one(ModelStub)
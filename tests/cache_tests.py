@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import unittest
+from gaebusiness import cache
+from gaebusiness.cache import LRUCache
+from mock import patch
+
+
+class LRUCacheTests(unittest.TestCase):
+    def test_get_and_set(self):
+        lru = LRUCache()
+        self.assertIsNone(lru.get('foo'))
+        lru.set('foo', 'bar')
+        self.assertEqual('bar', lru.get('foo'))
+        self.assertDictEqual({'entries': 1, 'hits': 1, 'misses': 1, 'evictions': 0}, lru.stats())
+
+    def test_eviction(self):
+        lru = LRUCache(max_entries=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertIsNone(lru.get('b'), 'least recently used entry should be evicted')
+        self.assertEqual(1, lru.get('a'))
+        self.assertEqual(3, lru.get('c'))
+        self.assertEqual(2, len(lru))
+        self.assertEqual(1, lru.evictions)
+
+    def test_ttl(self):
+        lru = LRUCache(ttl=10)
+        with patch.object(cache.time, 'time', return_value=100):
+            lru.set('foo', 'bar')
+        with patch.object(cache.time, 'time', return_value=110):
+            self.assertEqual('bar', lru.get('foo'))
+        with patch.object(cache.time, 'time', return_value=110.1):
+            self.assertIsNone(lru.get('foo'))
+        self.assertEqual(0, len(lru))
+        self.assertEqual(0, lru.evictions)
+
+    def test_clear(self):
+        lru = LRUCache()
+        lru.set('foo', 'bar')
+        lru.clear()
+        self.assertIsNone(lru.get('foo'))
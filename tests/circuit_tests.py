@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from gaebusiness import circuit
+from gaebusiness.circuit import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+from mock import patch
+from util import GAETestCase
+
+HOST = 'foo.bar.com'
+
+
+class CircuitBreakerTests(GAETestCase):
+    def _fail(self, breaker, times, timeout=False):
+        for _ in xrange(times):
+            self.assertTrue(breaker.allow(HOST))
+            breaker.record_failure(HOST, timeout)
+
+    def test_error_rate(self):
+        breaker = CircuitBreaker(error_rate=0.5, min_requests=4)
+        for _ in xrange(2):
+            breaker.allow(HOST)
+            breaker.record_success(HOST)
+        self._fail(breaker, 1)
+        self.assertEqual(CLOSED, breaker.state(HOST))
+        self._fail(breaker, 1)
+        self.assertEqual(OPEN, breaker.state(HOST))
+        self.assertFalse(breaker.allow(HOST))
+        self.assertTrue(breaker.allow('other.com'), 'circuits should be kept by host')
+
+    def test_timeouts(self):
+        breaker = CircuitBreaker(timeout_threshold=2, min_requests=100)
+        self._fail(breaker, 1, timeout=True)
+        self.assertEqual(CLOSED, breaker.state(HOST))
+        self._fail(breaker, 1, timeout=True)
+        self.assertEqual(OPEN, breaker.state(HOST))
+
+    def test_window(self):
+        breaker = CircuitBreaker(timeout_threshold=2, window=10)
+        with patch.object(circuit.time, 'time', return_value=100):
+            self._fail(breaker, 1, timeout=True)
+        with patch.object(circuit.time, 'time', return_value=111):
+            self._fail(breaker, 1, timeout=True)
+        self.assertEqual(CLOSED, breaker.state(HOST))
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(timeout_threshold=1, cool_down=30, probes=1)
+        with patch.object(circuit.time, 'time', return_value=100):
+            self._fail(breaker, 1, timeout=True)
+        with patch.object(circuit.time, 'time', return_value=129):
+            self.assertFalse(breaker.allow(HOST))
+        with patch.object(circuit.time, 'time', return_value=130):
+            self.assertTrue(breaker.allow(HOST))
+            self.assertEqual(HALF_OPEN, breaker.state(HOST))
+            self.assertFalse(breaker.allow(HOST), 'only probes requests should be allowed')
+            breaker.record_failure(HOST)
+            self.assertEqual(OPEN, breaker.state(HOST))
+        with patch.object(circuit.time, 'time', return_value=160):
+            self.assertTrue(breaker.allow(HOST))
+            breaker.record_success(HOST)
+        self.assertEqual(CLOSED, breaker.state(HOST))
+        self.assertDictEqual({OPEN: 2, HALF_OPEN: 2, CLOSED: 1}, breaker.stats()['transitions'])
+        self.assertDictEqual({HOST: CLOSED}, breaker.stats()['hosts'])
+
+    def test_unrecorded_probe_expires(self):
+        breaker = CircuitBreaker(timeout_threshold=1, cool_down=30, probes=1)
+        with patch.object(circuit.time, 'time', return_value=100):
+            self._fail(breaker, 1, timeout=True)
+        with patch.object(circuit.time, 'time', return_value=130):
+            self.assertTrue(breaker.allow(HOST))
+        with patch.object(circuit.time, 'time', return_value=159):
+            self.assertFalse(breaker.allow(HOST))
+        with patch.object(circuit.time, 'time', return_value=160):
+            self.assertTrue(breaker.allow(HOST), 'probe without outcome should be given up after cool_down')
+            self.assertFalse(breaker.allow(HOST))
+            breaker.record_success(HOST)
+        self.assertEqual(CLOSED, breaker.state(HOST))
+
+    def test_shared(self):
+        breaker = CircuitBreaker(timeout_threshold=1, shared=True)
+        other_instance_breaker = CircuitBreaker(shared=True, sync_interval=5)
+        self.assertTrue(other_instance_breaker.allow(HOST))
+        self._fail(breaker, 1, timeout=True)
+        self.assertTrue(other_instance_breaker.allow(HOST), 'memcache should be checked only after sync_interval')
+        other_instance_breaker = CircuitBreaker(shared=True)
+        self.assertFalse(other_instance_breaker.allow(HOST))
+        self.assertEqual(OPEN, other_instance_breaker.state(HOST))
+
+    def test_shared_memcache_accessed_out_of_lock(self):
+        breaker = CircuitBreaker(timeout_threshold=1, shared=True)
+
+        def assert_unlocked(*args, **kwargs):
+            self.assertFalse(breaker._lock.locked(), 'memcache should be accessed out of the lock')
+
+        with patch.object(circuit.memcache, 'get', side_effect=assert_unlocked) as get:
+            with patch.object(circuit.memcache, 'set', side_effect=assert_unlocked) as set_:
+                self._fail(breaker, 1, timeout=True)
+        self.assertEqual(1, get.call_count)
+        self.assertEqual(1, set_.call_count)
+        self.assertEqual(OPEN, breaker.state(HOST))
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from google.appengine.api import namespace_manager
+from google.appengine.ext import ndb
+from gaebusiness.fingerprint import query_fingerprint, FINGERPRINT_PREFIX
+from util import GAETestCase
+
+
+class FingerprintModel(ndb.Model):
+    name = ndb.StringProperty()
+    age = ndb.IntegerProperty()
+    height = ndb.FloatProperty()
+    parent_key = ndb.KeyProperty()
+
+
+class OtherModel(ndb.Model):
+    name = ndb.StringProperty()
+
+
+class QueryFingerprintTests(GAETestCase):
+    def assert_equivalent(self, query, other, **page_args):
+        self.assertEqual(query_fingerprint(query, **page_args), query_fingerprint(other, **page_args))
+
+    def assert_distinct(self, *fingerprints):
+        self.assertEqual(len(fingerprints), len(set(fingerprints)))
+
+    def test_equivalence(self):
+        FM = FingerprintModel
+        self.assert_equivalent(FM.query(FM.name == 'foo', FM.age == 1), FM.query(FM.age == 1, FM.name == 'foo'))
+        self.assert_equivalent(FM.query(FM.name == 'foo').filter(FM.age > 1),
+                               FM.query(FM.age > 1).filter(FM.name == 'foo'))
+        self.assert_equivalent(FM.query(FM.name.IN(['a', 'b'])), FM.query(FM.name.IN(['b', 'a'])))
+        self.assert_equivalent(FM.query(FM.name == str('foo')), FM.query(FM.name == 'foo'))
+        self.assert_equivalent(FM.query(FM.age == 1), FM.query(FM.age == long(1)))
+        self.assert_equivalent(FM.query(FM.parent_key == ndb.Key(FM, 1)), FM.query(FM.parent_key == ndb.Key(FM, 1)))
+        self.assert_equivalent(FM.query(projection=[FM.name, FM.age]), FM.query(projection=[FM.age, FM.name]))
+        self.assert_equivalent(FM.query(), FM.query(namespace=namespace_manager.get_namespace()))
+
+    def test_distinctness(self):
+        FM = FingerprintModel
+        FM(name='foo').put()
+        cursor = FM.query().fetch_page(1)[1]
+        self.assert_distinct(query_fingerprint(FM.query()),
+                             query_fingerprint(OtherModel.query()),
+                             query_fingerprint(FM.query(ancestor=ndb.Key(OtherModel, 1))),
+                             query_fingerprint(FM.query(ancestor=ndb.Key(OtherModel, 2))),
+                             query_fingerprint(FM.query(namespace='other')),
+                             query_fingerprint(FM.query(FM.name == 'foo')),
+                             query_fingerprint(FM.query(FM.name != 'foo')),
+                             query_fingerprint(FM.query(FM.age == 1)),
+                             query_fingerprint(FM.query(FM.height == 1.0)),
+                             query_fingerprint(FM.query(FM.name == 'foo', FM.age == 1)),
+                             query_fingerprint(FM.query(ndb.OR(FM.name == 'foo', FM.age == 1))),
+                             query_fingerprint(FM.query().order(FM.name)),
+                             query_fingerprint(FM.query().order(-FM.name)),
+                             query_fingerprint(FM.query().order(FM.name, FM.age)),
+                             query_fingerprint(FM.query().order(FM.age, FM.name)),
+                             query_fingerprint(FM.query(projection=[FM.name])),
+                             query_fingerprint(FM.query(projection=[FM.name], group_by=[FM.name])),
+                             query_fingerprint(FM.query(), page_size=10),
+                             query_fingerprint(FM.query(), page_size=20),
+                             query_fingerprint(FM.query(), page_size=10, offset=10),
+                             query_fingerprint(FM.query(), page_size=10, start_cursor=cursor),
+                             query_fingerprint(FM.query(), page_size=10, mode='projection'))
+
+    def test_same_cursor_on_different_queries(self):
+        FingerprintModel(name='foo').put()
+        OtherModel(name='foo').put()
+        cursor = FingerprintModel.query().fetch_page(1)[1]
+        self.assert_distinct(query_fingerprint(FingerprintModel.query(), 1, start_cursor=cursor),
+                             query_fingerprint(OtherModel.query(), 1, start_cursor=cursor),
+                             query_fingerprint(FingerprintModel.query(), 2, start_cursor=cursor))
+        self.assertEqual(query_fingerprint(FingerprintModel.query(), 1, start_cursor=cursor),
+                         query_fingerprint(FingerprintModel.query(), 1, start_cursor=cursor.urlsafe()))
+
+    def test_fixed_size(self):
+        long_name = 'x' * 1000
+        query = FingerprintModel.query(FingerprintModel.name.IN([long_name + str(i) for i in xrange(20)]))
+        fingerprint = query_fingerprint(query, 100)
+        self.assertTrue(fingerprint.startswith(FINGERPRINT_PREFIX))
+        self.assertEqual(len(query_fingerprint(FingerprintModel.query())), len(fingerprint))
+        self.assertLess(len(fingerprint), 250)
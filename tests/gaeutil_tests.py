@@ -1,21 +1,40 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
+import base64
+import os
+import threading
+import time
+import traceback
 import unittest
 import urllib
-from google.appengine.api import urlfetch, memcache
-from google.appengine.ext import ndb
+from google.appengine.api import urlfetch, memcache, apiproxy_stub_map, apiproxy_rpc, urlfetch_service_pb
+from google.appengine.api.apiproxy_stub_map import UserRPC
+from google.appengine.ext import ndb, deferred
+from google.appengine.runtime import apiproxy_errors
 import webapp2
 from webapp2_extras import i18n
 from gaebusiness import gaeutil
-from gaebusiness.business import CommandExecutionException
-from gaebusiness.gaeutil import UrlFetchCommand, TaskQueueCommand, ModelSearchCommand, SingleModelSearchCommand, \
-    NaiveSaveCommand, NaiveUpdateCommand, NaiveFindOrCreateModelCommand, SaveCommand, UpdateCommand, FindOrCreateCommand
+from gaebusiness.business import CommandExecutionException, CommandParallel, Command, CommandSequential
+from gaebusiness.cache import LRUCache
+from gaebusiness.circuit import CircuitBreaker
+from gaebusiness.gaeutil import UrlFetchCommand, UrlFetchBatchCommand, HedgePolicy, TaskQueueCommand, ModelSearchCommand, SingleModelSearchCommand, \
+    NaiveSaveCommand, NaiveUpdateCommand, NaiveFindOrCreateModelCommand, SaveCommand, UpdateCommand, FindOrCreateCommand, \
+    DeleteCommand
 from gaeforms.ndb.form import ModelForm
-from mock import Mock
+from mock import Mock, patch
 from util import GAETestCase
 
+DEADLINE_EXCEEDED = urlfetch_service_pb.URLFetchServiceError.DEADLINE_EXCEEDED
+INVALID_URL = urlfetch_service_pb.URLFetchServiceError.INVALID_URL
+SSL_CERTIFICATE_ERROR = urlfetch_service_pb.URLFetchServiceError.SSL_CERTIFICATE_ERROR
 
 class UrlfecthTests(unittest.TestCase):
+    def setUp(self):
+        self._create_rpc, self._make_fetch_call = urlfetch.create_rpc, urlfetch.make_fetch_call
+
+    def tearDown(self):
+        urlfetch.create_rpc, urlfetch.make_fetch_call = self._create_rpc, self._make_fetch_call
+
     def test_https_post(self):
         params = {'id': 'foo', 'token': 'bar'}
         url = 'https://foo.bar.com/rest'
@@ -71,6 +90,413 @@ class UrlfecthTests(unittest.TestCase):
     def test_http_404(self):
         self.test_http_400(404)
 
+    def test_http_500(self):
+        self.test_http_400(500)
+
+    def test_deadline_exceeded(self):
+        rpc = Mock()
+        rpc.get_result = Mock(side_effect=urlfetch.DeadlineExceededError('Deadline exceeded'))
+        gaeutil.urlfetch.create_rpc = Mock(return_value=rpc)
+        gaeutil.urlfetch.make_fetch_call = Mock()
+        command = UrlFetchCommand('http://foo.bar.com/rest')
+        self.assertRaises(CommandExecutionException, command.execute)
+        self.assertDictEqual({'fetch': 'DeadlineExceededError: Deadline exceeded'}, command.errors)
+
+
+class UrlFetchStubMock(object):
+    """
+    Urlfetch stub answering each fetch with next outcome, a status code, a tuple with status code and response
+    headers or an URLFetchServiceError code. outcomes may also be a dict with a list of outcomes for each url
+    """
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.urls = []
+        self.requests_headers = []
+
+    def CreateRPC(self):
+        return apiproxy_rpc.RPC(stub=self)
+
+    def MakeSyncCall(self, service, call, request, response, request_id=None):
+        self.urls.append(request.url())
+        self.requests_headers.append(dict((h.key(), h.value()) for h in request.header_list()))
+        outcomes = self.outcomes[request.url()] if isinstance(self.outcomes, dict) else self.outcomes
+        outcome, headers = outcomes.pop(0), {}
+        if isinstance(outcome, tuple):
+            outcome, headers = outcome
+        if outcome < 100:
+            raise apiproxy_errors.ApplicationError(outcome)
+        response.set_statuscode(outcome)
+        response.set_content(str('status %s' % outcome))
+        for key, value in headers.iteritems():
+            header = response.add_header()
+            header.set_key(key)
+            header.set_value(value)
+
+
+class UrlFetchRetryTests(GAETestCase):
+    def _execute(self, *outcomes, **policy_kwargs):
+        self.stub = UrlFetchStubMock(*outcomes)
+        apiproxy_stub_map.apiproxy.ReplaceStub('urlfetch', self.stub)
+        policy_kwargs.setdefault('backoff', 0)
+        cmd = UrlFetchCommand('http://foo.bar.com/rest', {'id': 1}, retry_policy=gaeutil.RetryPolicy(**policy_kwargs))
+        try:
+            cmd.execute()
+        except CommandExecutionException:
+            pass
+        return cmd
+
+    def test_success_without_retry(self):
+        cmd = self._execute(200)
+        self.assertEqual(1, cmd.attempts)
+        self.assertEqual('status 200', cmd.result.content)
+        self.assertDictEqual({}, cmd.errors)
+
+    def test_retry_on_server_error(self):
+        cmd = self._execute(503, DEADLINE_EXCEEDED, 200)
+        self.assertEqual(3, cmd.attempts)
+        self.assertEqual(200, cmd.result.status_code)
+        self.assertDictEqual({}, cmd.errors)
+        self.assertListEqual(['http://foo.bar.com/rest?id=1'] * 3, self.stub.urls)
+
+    def test_max_attempts(self):
+        cmd = self._execute(500, 500, 200, max_attempts=2)
+        self.assertEqual(2, cmd.attempts)
+        self.assertDictEqual({'http': 500, 'content': 'status 500'}, cmd.errors)
+
+        cmd = self._execute(DEADLINE_EXCEEDED, DEADLINE_EXCEEDED, max_attempts=2)
+        self.assertEqual(['fetch'], cmd.errors.keys())
+
+    def test_not_retryable_status(self):
+        cmd = self._execute(404, 200)
+        self.assertEqual(1, cmd.attempts)
+        self.assertEqual(404, cmd.errors['http'])
+
+    def test_budget(self):
+        with patch.object(gaeutil.RetryPolicy, 'delay', return_value=2):
+            cmd = self._execute(500, 200, budget=1)
+        self.assertEqual(1, cmd.attempts)
+
+    def test_backoff(self):
+        policy = gaeutil.RetryPolicy(backoff=0.1, max_backoff=0.3)
+        with patch.object(gaeutil.random, 'uniform', side_effect=lambda low, high: high):
+            self.assertListEqual([0.1, 0.2, 0.3, 0.3], [policy.delay(attempt) for attempt in xrange(1, 5)])
+
+    def test_retries_on_parallel(self):
+        self.stub = UrlFetchStubMock()
+        self.stub.outcomes = {'http://foo.bar.com/0': [500, 200], 'http://foo.bar.com/1': [DEADLINE_EXCEEDED, 200]}
+        apiproxy_stub_map.apiproxy.ReplaceStub('urlfetch', self.stub)
+        cmds = [UrlFetchCommand('http://foo.bar.com/%s' % i, retry_policy=gaeutil.RetryPolicy(backoff=0))
+                for i in xrange(2)]
+        CommandParallel(*cmds).execute()
+        self.assertListEqual([200, 200], [cmd.result.status_code for cmd in cmds])
+        self.assertListEqual([2, 2], [cmd.attempts for cmd in cmds])
+
+
+class UrlFetchCircuitBreakerTests(GAETestCase):
+    def setUp(self):
+        super(UrlFetchCircuitBreakerTests, self).setUp()
+        self.breaker = CircuitBreaker(timeout_threshold=2)
+
+    def _execute(self, *outcomes, **kwargs):
+        self.stub = UrlFetchStubMock(*outcomes)
+        apiproxy_stub_map.apiproxy.ReplaceStub('urlfetch', self.stub)
+        cmd = UrlFetchCommand('http://foo.bar.com/rest', circuit_breaker=self.breaker, **kwargs)
+        try:
+            cmd.execute()
+        except CommandExecutionException:
+            pass
+        return cmd
+
+    def test_open(self):
+        self._execute(DEADLINE_EXCEEDED)
+        self._execute(DEADLINE_EXCEEDED)
+        cmd = self._execute()
+        self.assertListEqual([], self.stub.urls, 'fetch should not be done on open circuit')
+        self.assertDictEqual({'circuit': 'Circuit open for host foo.bar.com'}, cmd.errors)
+
+    def test_client_errors_are_successes(self):
+        self.breaker = CircuitBreaker(error_rate=0.5, min_requests=2)
+        self._execute(404)
+        self._execute(404)
+        self._execute(503)
+        self.assertEqual('closed', self.breaker.state('foo.bar.com'))
+        self._execute(503)
+        self.assertEqual('open', self.breaker.state('foo.bar.com'))
+
+    def test_outcome_recorded_on_any_fetch_error(self):
+        self.breaker = CircuitBreaker(error_rate=0.5, min_requests=1)
+        self.assertRaises(urlfetch.SSLCertificateError, self._execute, SSL_CERTIFICATE_ERROR)
+        self.assertEqual('open', self.breaker.state('foo.bar.com'))
+
+    def test_retries_stop_on_open(self):
+        cmd = self._execute(DEADLINE_EXCEEDED, DEADLINE_EXCEEDED, 200, retry_policy=gaeutil.RetryPolicy(backoff=0))
+        self.assertEqual(2, cmd.attempts)
+        self.assertIn('fetch', cmd.errors)
+
+
+class UrlFetchHttpCacheTests(GAETestCase):
+    def _execute(self, *outcomes, **kwargs):
+        self.stub = UrlFetchStubMock(*outcomes)
+        apiproxy_stub_map.apiproxy.ReplaceStub('urlfetch', self.stub)
+        return UrlFetchCommand('http://foo.bar.com/rest', http_cache=True, **kwargs).execute()
+
+    def test_revalidation(self):
+        cmd = self._execute((200, {'ETag': '"v1"', 'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'}))
+        self.assertFalse(cmd.from_cache)
+        self.assertEqual('status 200', cmd.result.content)
+
+        cmd = self._execute(304)
+        self.assertTrue(cmd.from_cache)
+        self.assertEqual('status 200', cmd.result.content)
+        self.assertEqual(200, cmd.result.status_code)
+        self.assertEqual('"v1"', cmd.result.headers['ETag'], 'cached headers should be case insensitive')
+        self.assertEqual('"v1"', self.stub.requests_headers[0]['If-None-Match'])
+        self.assertEqual('Mon, 01 Jan 2024 00:00:00 GMT', self.stub.requests_headers[0]['If-Modified-Since'])
+
+        cmd = self._execute((200, {'ETag': '"v2"'}))
+        self.assertFalse(cmd.from_cache)
+        self.assertEqual('"v1"', self.stub.requests_headers[0]['If-None-Match'])
+        self._execute(304)
+        self.assertEqual('"v2"', self.stub.requests_headers[0]['If-None-Match'])
+
+    def test_max_age(self):
+        self._execute((200, {'Cache-Control': 'public, max-age=60'}))
+        cmd = self._execute()
+        self.assertTrue(cmd.from_cache)
+        self.assertListEqual([], self.stub.urls, 'fresh response should be served without fetching')
+        with patch.object(gaeutil.time, 'time', return_value=time.time() + 61):
+            cmd = self._execute((200, {}))
+        self.assertFalse(cmd.from_cache)
+
+    def test_not_cached(self):
+        for headers in ({}, {'ETag': '"v1"', 'Cache-Control': 'no-store'}):
+            self._execute((200, headers))
+            self.assertFalse(self._execute(200).from_cache)
+            self.assertNotIn('If-None-Match', self.stub.requests_headers[0])
+        self.assertRaises(CommandExecutionException, self._execute, (500, {'ETag': '"v1"'}))
+        self.assertRaises(CommandExecutionException, self._execute, 500)
+        self.assertNotIn('If-None-Match', self.stub.requests_headers[0])
+
+    def test_cache_key(self):
+        self._execute((200, {'ETag': '"v1"'}), headers={'Accept-Language': 'pt', 'X-Request-Id': '1'},
+                      cache_headers=['accept-language'])
+        self._execute(304, headers={'Accept-Language': 'pt', 'X-Request-Id': '2'}, cache_headers=['accept-language'])
+        self.assertIn('If-None-Match', self.stub.requests_headers[0])
+        self._execute(200, headers={'Accept-Language': 'en'}, cache_headers=['accept-language'])
+        self.assertNotIn('If-None-Match', self.stub.requests_headers[0])
+
+    def test_only_get(self):
+        self.stub = UrlFetchStubMock((200, {'ETag': '"v1"'}), 200)
+        apiproxy_stub_map.apiproxy.ReplaceStub('urlfetch', self.stub)
+        for _ in xrange(2):
+            UrlFetchCommand('http://foo.bar.com/rest', method=urlfetch.POST, http_cache=True).execute()
+        self.assertNotIn('If-None-Match', self.stub.requests_headers[1])
+
+
+class SlowUrlFetchStubMock(UrlFetchStubMock):
+    """
+    Urlfetch stub answering each fetch with next outcome after waiting its seconds. outcomes are tuples with seconds
+    and outcome, taken on the order fetches are waited
+    """
+    THREADSAFE = True
+
+    def __init__(self, *outcomes):
+        super(SlowUrlFetchStubMock, self).__init__()
+        self.timed_outcomes = list(outcomes)
+        self._lock = threading.Lock()
+
+    def MakeSyncCall(self, *args, **kwargs):
+        with self._lock:
+            seconds, outcome = self.timed_outcomes.pop(0)
+        time.sleep(seconds)
+        with self._lock:
+            self.outcomes = [outcome]
+            return super(SlowUrlFetchStubMock, self).MakeSyncCall(*args, **kwargs)
+
+
+class UrlFetchHedgeTests(GAETestCase):
+    def _execute(self, policy, *outcomes, **kwargs):
+        """
+        :param outcomes: tuples with seconds and outcome of each fetch
+        """
+        self.stub = SlowUrlFetchStubMock(*outcomes)
+        apiproxy_stub_map.apiproxy.ReplaceStub('urlfetch', self.stub)
+        return UrlFetchCommand('http://foo.bar.com/rest', hedge_policy=policy, **kwargs).execute()
+
+    def _wait_hedges(self, policy):
+        # Losing fetches keep running on their threads after command is done
+        while policy.stats()['foo.bar.com']['in_flight']:
+            time.sleep(0.01)
+
+    def test_hedge_wins(self):
+        policy = HedgePolicy(delay=0.05)
+        started = time.time()
+        cmd = self._execute(policy, (0.5, 500), (0.01, 200))
+        self.assertLess(time.time() - started, 0.3, 'hedge should be sent while primary RPC is waited')
+        self.assertEqual(200, cmd.result.status_code)
+        self.assertEqual(1, cmd.hedges)
+        self.assertTrue(cmd.hedge_won)
+        self.assertDictContainsSubset({'hedges': 1, 'wins': 1, 'in_flight': 0}, policy.stats()['foo.bar.com'])
+
+    def test_primary_wins(self):
+        policy = HedgePolicy(delay=0.05)
+        cmd = self._execute(policy, (0.1, 200), (0.3, 500))
+        self.assertEqual(200, cmd.result.status_code)
+        self._wait_hedges(policy)
+        self.assertFalse(cmd.hedge_won)
+        self.assertDictContainsSubset({'hedges': 1, 'wins': 0}, policy.stats()['foo.bar.com'])
+
+    def test_fast_response_not_hedged(self):
+        policy = HedgePolicy(delay=0.5)
+        cmd = self._execute(policy, (0, 200))
+        started = time.time()
+        ndb.eventloop.run()
+        self.assertLess(time.time() - started, 0.1, 'no timer should be left waiting for hedge delay')
+        self.assertEqual(0, cmd.hedges)
+        self.assertEqual(1, cmd.attempts)
+        self.assertDictContainsSubset({'hedges': 0, 'in_flight': 0}, policy.stats()['foo.bar.com'])
+
+    def test_observed_percentile(self):
+        policy = HedgePolicy(min_samples=3)
+        for _ in xrange(3):
+            self.assertEqual(0, self._execute(policy, (0.005, 200)).hedges, 'no hedge before min samples')
+        self.assertAlmostEqual(0.01, policy.hedge_delay('foo.bar.com'), delta=0.01)
+        self.assertEqual(1, self._execute(policy, (0.2, 200), (0, 200)).hedges)
+
+    def test_parallel_commands_overlap(self):
+        stub = SlowUrlFetchStubMock(*[(0.2, 200)] * 3)
+        apiproxy_stub_map.apiproxy.ReplaceStub('urlfetch', stub)
+        policy = HedgePolicy(delay=1)
+        started = time.time()
+        CommandParallel(*[UrlFetchCommand('http://foo.bar.com/rest', hedge_policy=policy) for _ in xrange(3)]).execute()
+        self.assertLess(time.time() - started, 0.5)
+
+    def test_max_in_flight(self):
+        stub = SlowUrlFetchStubMock((0.15, 200), (0.15, 200), (0.4, 200))
+        apiproxy_stub_map.apiproxy.ReplaceStub('urlfetch', stub)
+        policy = HedgePolicy(delay=0.05, max_in_flight=1)
+        commands = [UrlFetchCommand('http://foo.bar.com/rest', hedge_policy=policy) for _ in xrange(2)]
+        CommandParallel(*commands).execute()
+        self.assertItemsEqual([0, 1], [cmd.hedges for cmd in commands])
+        self.assertEqual(1, policy.stats()['foo.bar.com']['in_flight'], 'losing hedge should still be running')
+        self._wait_hedges(policy)
+        self.assertDictContainsSubset({'hedges': 1, 'in_flight': 0}, policy.stats()['foo.bar.com'])
+
+    def test_hedge_raising_is_released(self):
+        policy = HedgePolicy(delay=0.05, max_in_flight=1)
+        for _ in xrange(2):
+            cmd = self._execute(policy, (0.1, 200), (0, SSL_CERTIFICATE_ERROR))
+            self.assertEqual(200, cmd.result.status_code)
+            self.assertEqual(1, cmd.hedges, 'failed hedge should not keep its slot')
+            self.assertFalse(cmd.hedge_won)
+        self.assertDictContainsSubset({'hedges': 2, 'wins': 0, 'in_flight': 0}, policy.stats()['foo.bar.com'])
+
+    def test_primary_raising(self):
+        policy = HedgePolicy(delay=0.05)
+        cmd = self._execute(policy, (0.1, SSL_CERTIFICATE_ERROR), (0.1, 200))
+        self.assertEqual(200, cmd.result.status_code)
+        self.assertTrue(cmd.hedge_won)
+        self.assertDictContainsSubset({'wins': 1, 'in_flight': 0}, policy.stats()['foo.bar.com'])
+
+    def test_primary_raising_before_hedge(self):
+        policy = HedgePolicy(delay=0.5)
+        cmd = UrlFetchCommand('http://foo.bar.com/rest', hedge_policy=policy)
+        self.stub = SlowUrlFetchStubMock((0, SSL_CERTIFICATE_ERROR))
+        apiproxy_stub_map.apiproxy.ReplaceStub('urlfetch', self.stub)
+        started = time.time()
+        self.assertRaises(urlfetch.SSLCertificateError, cmd.execute)
+        self.assertLess(time.time() - started, 0.3, 'failed primary should not wait for hedge delay')
+        self.assertEqual(0, cmd.hedges)
+
+    def test_not_idempotent(self):
+        cmd = UrlFetchCommand('http://foo.bar.com/rest', method=urlfetch.POST, hedge_policy=HedgePolicy(delay=0))
+        self.assertIsNone(cmd.hedge_policy)
+
+    def test_failed_fetch_waits_other(self):
+        cmd = self._execute(HedgePolicy(delay=0), (0.05, DEADLINE_EXCEEDED), (0.1, 200))
+        self.assertEqual(200, cmd.result.status_code, 'failed fetch should wait for the other one')
+        self.assertEqual(2, cmd.attempts)
+
+
+class InFlightUrlFetchStubMock(UrlFetchStubMock):
+    """
+    Keeps max number of fetches created and not yet answered
+    """
+
+    def __init__(self, *outcomes):
+        super(InFlightUrlFetchStubMock, self).__init__(*outcomes)
+        self.in_flight = self.max_in_flight = 0
+
+    def CreateRPC(self):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return super(InFlightUrlFetchStubMock, self).CreateRPC()
+
+    def MakeSyncCall(self, *args, **kwargs):
+        self.in_flight -= 1
+        return super(InFlightUrlFetchStubMock, self).MakeSyncCall(*args, **kwargs)
+
+
+class UrlFetchBatchTests(GAETestCase):
+    def setUp(self):
+        super(UrlFetchBatchTests, self).setUp()
+        self.urls = ['http://foo.bar.com/%s' % i for i in xrange(7)]
+        self.stub = InFlightUrlFetchStubMock()
+        self.stub.outcomes = dict((url, [200]) for url in self.urls)
+        self.stub.outcomes[self.urls[3]] = [404]
+        apiproxy_stub_map.apiproxy.ReplaceStub('urlfetch', self.stub)
+
+    def test_results_on_urls_order(self):
+        cmd = UrlFetchBatchCommand(self.urls, max_in_flight=3).execute()
+        self.assertListEqual(['status 200'] * 3 + ['status 404'] + ['status 200'] * 3,
+                             [response.content for response in cmd.result])
+        self.assertListEqual([self.urls[3]], cmd.url_errors.keys())
+        self.assertIn('http', cmd.url_errors[self.urls[3]])
+        self.assertDictEqual({}, cmd.errors, 'url errors should not fail the batch')
+        self.assertEqual(3, self.stub.max_in_flight)
+        self.assertListEqual(sorted(self.urls), sorted(self.stub.urls))
+
+    def test_callback(self):
+        fetched = []
+        cmd = UrlFetchBatchCommand(iter(self.urls), max_in_flight=2,
+                                   callback=lambda url, fetch: fetched.append((url, fetch.result.status_code)))
+        cmd.execute()
+        self.assertIsNone(cmd.result)
+        self.assertEqual(2, self.stub.max_in_flight)
+        self.assertItemsEqual([(url, 404 if i == 3 else 200) for i, url in enumerate(self.urls)], fetched)
+
+    def test_fetch_errors(self):
+        self.stub.outcomes[self.urls[0]] = [DEADLINE_EXCEEDED]
+        cmd = UrlFetchBatchCommand(self.urls, max_in_flight=4, deadline=1).execute()
+        self.assertIsNone(cmd.result[0])
+        self.assertItemsEqual([self.urls[0], self.urls[3]], cmd.url_errors.keys())
+        self.assertIn('fetch', cmd.url_errors[self.urls[0]])
+
+    def test_errors_not_raised_by_urlfetch_commands(self):
+        self.stub.outcomes[self.urls[0]] = [INVALID_URL]
+        fetched = []
+        cmd = UrlFetchBatchCommand(self.urls, max_in_flight=1, callback=lambda url, fetch: fetched.append(url))
+        cmd.execute()
+        self.assertListEqual(self.urls, fetched)
+        self.assertItemsEqual([self.urls[0], self.urls[3]], cmd.url_errors.keys())
+        self.assertIn('InvalidURLError', cmd.url_errors[self.urls[0]]['fetch'])
+
+    def test_iter_fetches(self):
+        cmd = UrlFetchBatchCommand(self.urls, max_in_flight=3)
+        fetched = []
+        for url, fetch in cmd.iter_fetches():
+            self.assertLessEqual(self.stub.max_in_flight, 3)
+            fetched.append(url)
+        self.assertItemsEqual(self.urls, fetched)
+        self.assertListEqual([self.urls[3]], cmd.url_errors.keys())
+
+    def test_inside_parallel(self):
+        batch = UrlFetchBatchCommand(self.urls[:3], max_in_flight=2)
+        CommandParallel(batch, UrlFetchBatchCommand(self.urls[4:], max_in_flight=2)).execute()
+        self.assertEqual(3, len(batch.result))
+        self.assertLessEqual(self.stub.max_in_flight, 4)
+
 
 class TaskQueueTests(unittest.TestCase):
     def test_queue_creation(self):
@@ -79,14 +505,13 @@ class TaskQueueTests(unittest.TestCase):
         rpc_mock = Mock()
         queue_obj = Mock()
         queue_cls = Mock(return_value=queue_obj)
-        gaeutil.Queue = queue_cls
-        gaeutil.taskqueue.create_rpc = Mock(return_value=rpc_mock)
-        gaeutil.Task = task_cls
         queue_name = 'foo'
         params = {'param1': 'bar'}
         url = '/mytask'
-        cmd = TaskQueueCommand(queue_name, url, params=params)
-        cmd.execute()
+        with patch.object(gaeutil, 'Queue', queue_cls), patch.object(gaeutil, 'Task', task_cls), \
+                patch.object(gaeutil.taskqueue, 'create_rpc', Mock(return_value=rpc_mock)):
+            cmd = TaskQueueCommand(queue_name, url, params=params)
+            cmd.execute()
         task_cls.assert_called_once_with(url=url, params=params)
         queue_obj.add_async.assert_called_once_with(task_obj, rpc=rpc_mock)
         rpc_mock.get_result.assert_called_once_with()
@@ -127,7 +552,7 @@ class ModelSearchCommandTests(GAETestCase):
         cursor = cmd.execute().cursor
         cached = memcache.get(cmd._cache_key())
         self.assertIsNotNone(cached)
-        cached_model_keys, cached_cursor = cached
+        cached_model_keys, cached_cursor, generation, more, cached_at = cached
         cached_models = ndb.get_multi(cached_model_keys)
         self.assertListEqual(list(xrange(3)), [some_model.index for some_model in cached_models])
 
@@ -138,29 +563,54 @@ class ModelSearchCommandTests(GAETestCase):
 
         # asserting items are cached
         cmd = ModelSearchCommand(SomeModel.query_index_ordered(), 3, cursor, cache_begin=False).execute()
-        cached_model_keys, cached_cursor = memcache.get(cmd._cache_key())
+        cached_model_keys, cached_cursor, generation, more, cached_at = memcache.get(cmd._cache_key())
         cached_models = ndb.get_multi(cached_model_keys)
         self.assertListEqual(list(xrange(3, 6)), [some_model.index for some_model in cached_models])
         self.assertEqual(cursor2, cached_cursor)
 
         # asserting cached with offset
         cmd = ModelSearchCommand(SomeModel.query_index_ordered(), 3, offset=3).execute()
-        cached_model_keys, cached_cursor = memcache.get(cmd._cache_key())
+        cached_model_keys, cached_cursor, generation, more, cached_at = memcache.get(cmd._cache_key())
         cached_models = ndb.get_multi(cached_model_keys)
         self.assertListEqual(list(xrange(3, 6)), [some_model.index for some_model in cached_models])
         self.assertEqual(cursor2, cached_cursor)
 
         # asserting cached is used
-        cmd = ModelSearchCommand(SomeModel.query_index_ordered(), 3, cursor).execute()
-        self.assertIsNone(cmd._ModelSearchCommand__future)
+        with patch.object(ndb, 'get_multi', side_effect=AssertionError('cached models should be fetched async')):
+            cmd = ModelSearchCommand(SomeModel.query_index_ordered(), 3, cursor).execute()
         self.assertIsNotNone(cmd._ModelSearchCommand__cached_keys)
         self._assert_result(cmd, 3, 6)
 
 
-        # asserting results are not cached if len of results are less then search page_size
-        ModelSearchCommand(SomeModel.query_index_ordered(), 3, cursor2).execute()
-        self.assertIsNone(memcache.get(cursor2.urlsafe()))
-
+        # asserting last page is cached with its more value
+        cmd = ModelSearchCommand(SomeModel.query_index_ordered(), 3, cursor2).execute()
+        cached_model_keys, cached_cursor, generation, more, cached_at = memcache.get(cmd._cache_key())
+        self.assertEqual(1, len(cached_model_keys))
+        self.assertFalse(more)
+        with patch.object(ndb.Query, 'fetch_page_async', side_effect=AssertionError('last page should be cached')):
+            cmd = ModelSearchCommand(SomeModel.query_index_ordered(), 3, cursor2).execute()
+        self._assert_result(cmd, 6, 7)
+        self.assertFalse(cmd.more)
+
+
+    def test_short_listing_cache(self):
+        ndb.put_multi([SomeModel(index=i) for i in xrange(2)])
+        ModelSearchCommand(SomeModel.query_index_ordered(), 3).execute()
+        with patch.object(ndb.Query, 'fetch_page_async', side_effect=AssertionError('short page should be cached')):
+            cmd = ModelSearchCommand(SomeModel.query_index_ordered(), 3).execute()
+        self._assert_result(cmd, 0, 2)
+        self.assertFalse(cmd.more)
+
+    def test_tail_cache_time(self):
+        ndb.put_multi([SomeModel(index=i) for i in xrange(4)])
+        first_page = ModelSearchCommand(SomeModel.query_index_ordered(), 3)
+        last_page = ModelSearchCommand(SomeModel.query_index_ordered(), 3, offset=3)
+        with patch.object(ndb.Context, 'memcache_set', wraps=ndb.get_context().memcache_set) as memcache_set:
+            first_page.execute()
+            last_page.execute()
+        times = dict((args[0], kwargs.get('time')) for args, kwargs in memcache_set.call_args_list)
+        self.assertEqual(0, times[first_page._cache_key()])
+        self.assertEqual(ModelSearchCommand.tail_cache_time, times[last_page._cache_key()])
 
     def test_offset_search(self):
         ndb.put_multi([SomeModel(index=i) for i in xrange(10)])
@@ -193,6 +643,403 @@ class ModelSearchCommandTests(GAETestCase):
         self._assert_result(search, 6, 8)
 
 
+def _execute_recording_rpcs(cmd):
+    rpcs = []
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('record_rpcs', lambda service, call, request, response:
+                                                         rpcs.append((service, call)))
+    try:
+        cmd.execute()
+    finally:
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Clear()
+    return rpcs
+
+
+class ParallelSearchesTests(GAETestCase):
+    def _searches(self):
+        return [ModelSearchCommand(SomeModel.query(SomeModel.index >= i).order(SomeModel.index), 2) for i in xrange(8)]
+
+    def test_single_cache_lookup(self):
+        ndb.put_multi([SomeModel(index=i) for i in xrange(10)])
+        ndb.Future.wait_all(gaeutil.invalidate_search_cache('SomeModel'))
+        rpcs = _execute_recording_rpcs(CommandParallel(*self._searches()))
+        self.assertEqual(('memcache', 'Get'), rpcs[0])
+        self.assertEqual(1, rpcs.count(('memcache', 'Get')), 'cache lookups should be made only on first rpc')
+
+        ndb.get_context().clear_cache()
+        searches = self._searches()
+        rpcs = _execute_recording_rpcs(CommandParallel(*searches))
+        self.assertEqual(('memcache', 'Get'), rpcs[0])
+        self.assertNotIn('RunQuery', [call for service, call in rpcs], 'all searches should be cached')
+        self.assertListEqual([[i, i + 1] for i in xrange(8)], [[m.index for m in s.result] for s in searches])
+
+
+class ProjectedModel(ndb.Model):
+    index = ndb.IntegerProperty()
+    name = ndb.StringProperty(required=True)
+    content = ndb.TextProperty()
+
+
+class ProjectionSearchTests(GAETestCase):
+    def setUp(self):
+        super(ProjectionSearchTests, self).setUp()
+        ndb.put_multi([ProjectedModel(index=i, name='name %s' % i, content='x' * 1000) for i in xrange(5)])
+
+    def _search(self, **kwargs):
+        query = ProjectedModel.query().order(ProjectedModel.index)
+        return ModelSearchCommand(query, 2, projection=[ProjectedModel.index, 'name'], **kwargs)
+
+    def _assert_projected(self, models, begin, end):
+        self.assertListEqual([(i, 'name %s' % i) for i in xrange(begin, end)], [(m.index, m.name) for m in models])
+        self.assertTrue(all(m.key == ndb.Key(ProjectedModel, m.key.id()) for m in models))
+        self.assertRaises(ndb.UnprojectedPropertyError, getattr, models[0], 'content')
+
+    def test_single_query_rpc(self):
+        rpcs = _execute_recording_rpcs(self._search(use_cache=False))
+        calls = [call for service, call in rpcs if service == 'datastore_v3']
+        self.assertEqual(1, calls.count('RunQuery'))
+        self.assertNotIn('Get', calls, 'projected entities should come from query')
+
+    def test_cache(self):
+        search = self._search()
+        search()
+        self._assert_projected(search.result, 0, 2)
+        self.assertIsNotNone(memcache.get(search._cache_key()))
+
+        with patch.object(ndb.Query, 'fetch_page_async', side_effect=AssertionError('page should be cached')):
+            cached_search = self._search()
+            cached_search()
+        self._assert_projected(cached_search.result, 0, 2)
+        self.assertEqual(search.cursor, cached_search.cursor)
+
+        self._assert_projected(self._search(start_cursor=search.cursor)(), 2, 4)
+
+    def test_cache_key(self):
+        query = ProjectedModel.query().order(ProjectedModel.index)
+        self.assertEqual(self._search()._cache_key(),
+                         ModelSearchCommand(query, 2, projection=['name', 'index'])._cache_key())
+        self.assertNotEqual(self._search()._cache_key(), ModelSearchCommand(query, 2)._cache_key())
+        self.assertNotEqual(self._search()._cache_key(), ModelSearchCommand(query, 2, projection=['index'])._cache_key())
+
+    def test_iter_pages(self):
+        pages = list(self._search().iter_pages())
+        self.assertEqual(3, len(pages))
+        self._assert_projected(pages[1], 2, 4)
+
+
+class OffsetTranslationTests(GAETestCase):
+    def setUp(self):
+        super(OffsetTranslationTests, self).setUp()
+        ndb.put_multi([SomeModel(index=i) for i in xrange(10)])
+        ndb.Future.wait_all(gaeutil.invalidate_search_cache('SomeModel'))
+
+    def _search(self, offset):
+        cmd = ModelSearchCommand(SomeModel.query_index_ordered(), 3, offset=offset)
+        cmd.query.fetch_page_async = Mock(wraps=cmd.query.fetch_page_async)
+        cmd()
+        return cmd
+
+    def _assert_search(self, offset, expected_start_cursor, expected_offset):
+        cmd = self._search(offset)
+        self.assertListEqual(range(offset, min(offset + 3, 10)), [m.index for m in cmd.result])
+        call_kwargs = cmd.query.fetch_page_async.call_args[1]
+        self.assertEqual(expected_start_cursor, call_kwargs['start_cursor'])
+        self.assertEqual(expected_offset, call_kwargs['offset'])
+        return cmd
+
+    def test_resume_from_nearest_boundary(self):
+        first_page = self._assert_search(3, None, 3)
+        second_page = self._assert_search(6, first_page.cursor, 0)
+        self._assert_search(8, first_page.cursor, 2)
+        self.assertListEqual([6, 9, 10], sorted(memcache.get(second_page._offset_cursors_key())[1]))
+
+    def test_first_page_not_translated(self):
+        cmd = self._assert_search(0, None, 0)
+        self.assertIsNone(memcache.get(cmd._offset_cursors_key()))
+
+    def test_boundary_set_with_page(self):
+        cmd = ModelSearchCommand(SomeModel.query_index_ordered(), 3, offset=3)
+        rpcs = _execute_recording_rpcs(cmd)
+        self.assertEqual(1, rpcs.count(('memcache', 'Set')), 'page and boundary should be set on a single rpc')
+        self.assertIsNotNone(memcache.get(cmd._cache_key()))
+        self.assertListEqual([6], memcache.get(cmd._offset_cursors_key())[1].keys())
+
+    def test_cursor_search_not_translated(self):
+        first_page = self._search(0)
+        cmd = ModelSearchCommand(SomeModel.query_index_ordered(), 3, first_page.cursor, offset=3)()
+        self.assertListEqual([6, 7, 8], [m.index for m in cmd])
+
+    def test_invalidation(self):
+        self._search(3)
+        NaiveSaveCommand(SomeModel, {'index': -1})()
+        cmd = ModelSearchCommand(SomeModel.query_index_ordered(), 3, offset=6)()
+        self.assertListEqual([5, 6, 7], [m.index for m in cmd])
+
+    def test_limit(self):
+        with patch.object(gaeutil, 'OFFSET_CURSORS_LIMIT', 2):
+            for offset in (3, 6, 9):
+                self._search(offset)
+            cmd = self._assert_search(1, None, 1)
+        self.assertListEqual([9, 10], sorted(memcache.get(cmd._offset_cursors_key())[1]))
+
+def _done_future(result=None):
+    future = ndb.Future()
+    future.set_result(result)
+    return future
+
+
+class LockOnMissSearchTests(GAETestCase):
+    def setUp(self):
+        super(LockOnMissSearchTests, self).setUp()
+        ndb.put_multi([SomeModel(index=i) for i in xrange(1, 4)])
+
+    def _search(self):
+        return ModelSearchCommand(SomeModel.query_index_ordered(), 2, lock_on_miss=True)
+
+    def _hold_lease(self):
+        search = self._search()
+        self.assertTrue(memcache.add(search._lease_key(search._cache_key()), True))
+        return search
+
+    def _execute_without_query(self, search):
+        with patch.object(ndb.Query, 'fetch_page_async', side_effect=AssertionError('query should not be executed')):
+            return [m.index for m in search()]
+
+    def test_lease_released(self):
+        search = self._search()
+        self.assertListEqual([1, 2], [m.index for m in search()])
+        self.assertIsNone(memcache.get(search._lease_key(search._cache_key())))
+        self.assertListEqual([1, 2], self._execute_without_query(self._search()))
+
+    def test_lease_released_on_query_error(self):
+        search = self._search()
+        with patch.object(ndb.Query, 'fetch_page_async', side_effect=ValueError()):
+            self.assertRaises(ValueError, search)
+        self.assertIsNone(memcache.get(search._lease_key(search._cache_key())))
+
+    def test_stale_page_served_while_leased(self):
+        self._search()()
+        NaiveSaveCommand(SomeModel, {'index': 0})()
+        self.assertListEqual([1, 2], self._execute_without_query(self._hold_lease()))
+
+    def test_wait_fresh_page(self):
+        search = self._search()
+        search()
+        cached_tuple = memcache.get(search._cache_key())
+        memcache.delete(search._cache_key())
+        self._hold_lease()
+
+        def cache_page(seconds):
+            memcache.set(search._cache_key(), cached_tuple)
+            return _done_future()
+
+        with patch.object(ndb, 'sleep', side_effect=cache_page):
+            self.assertListEqual([1, 2], self._execute_without_query(self._search()))
+
+    def test_lease_expired(self):
+        search = self._hold_lease()
+
+        def expire_lease(seconds):
+            memcache.delete(search._lease_key(search._cache_key()))
+            return _done_future()
+
+        with patch.object(ndb, 'sleep', side_effect=expire_lease) as sleep:
+            self.assertListEqual([1, 2], [m.index for m in self._search()()])
+        self.assertEqual(1, sleep.call_count)
+
+
+class SoftTtlSearchTests(GAETestCase):
+    def setUp(self):
+        super(SoftTtlSearchTests, self).setUp()
+        ndb.put_multi([SomeModel(index=i) for i in xrange(1, 4)])
+
+    def _search(self):
+        query = SomeModel.query(SomeModel.index < 10).order(-SomeModel.index)
+        return ModelSearchCommand(query, 2, soft_ttl=60)
+
+    def _expire_soft_ttl(self):
+        cache_key = self._search()._cache_key()
+        cached_tuple = memcache.get(cache_key)
+        memcache.set(cache_key, cached_tuple[:4] + (cached_tuple[4] - 61,))
+
+    def _tasks(self):
+        return self.testbed.get_stub('taskqueue').GetTasks('default')
+
+    def _search_without_query(self):
+        with patch.object(ndb.Query, 'fetch_page_async', side_effect=AssertionError('query should not be executed')):
+            return [m.index for m in self._search()()]
+
+    def test_fresh_page(self):
+        self._search()()
+        self.assertListEqual([3, 2], self._search_without_query())
+        self.assertListEqual([], self._tasks())
+
+    def test_stale_page_refresh(self):
+        self._search()()
+        SomeModel(index=4).put()
+        self._expire_soft_ttl()
+        self.assertListEqual([3, 2], self._search_without_query())
+        self.assertListEqual([3, 2], self._search_without_query())
+        tasks = self._tasks()
+        self.assertEqual(1, len(tasks), 'refresh task should be added only once')
+
+        deferred.run(base64.b64decode(tasks[0]['body']))
+        self.assertListEqual([4, 3], self._search_without_query())
+
+
+class LocalCacheSearchTests(GAETestCase):
+    def setUp(self):
+        super(LocalCacheSearchTests, self).setUp()
+        ModelSearchCommand.local_cache = LRUCache()
+
+    def tearDown(self):
+        ModelSearchCommand.local_cache = None
+        super(LocalCacheSearchTests, self).tearDown()
+
+    def _search(self):
+        return [m.index for m in ModelSearchCommand(SomeModel.query_index_ordered(), 2)()]
+
+    def test_local_hit(self):
+        ndb.put_multi([SomeModel(index=i) for i in xrange(3)])
+        self.assertListEqual([0, 1], self._search())
+        with patch.object(ndb.Context, 'memcache_get', side_effect=AssertionError('page should be cached locally')):
+            self.assertListEqual([0, 1], self._search())
+        self.assertEqual(1, ModelSearchCommand.local_cache.hits)
+
+    def test_memcache_hit_fills_local_cache(self):
+        ndb.put_multi([SomeModel(index=i) for i in xrange(3)])
+        self._search()
+        ModelSearchCommand.local_cache.clear()
+        self._search()
+        self.assertEqual(1, len(ModelSearchCommand.local_cache))
+
+    def test_invalidation(self):
+        ndb.put_multi([SomeModel(index=i) for i in xrange(1, 3)])
+        self._search()
+        NaiveSaveCommand(SomeModel, {'index': 0})()
+        self.assertListEqual([0, 1], self._search())
+
+    def test_invalidation_while_querying(self):
+        ndb.put_multi([SomeModel(index=i) for i in xrange(1, 3)])
+        fetch_page_async = ndb.Query.fetch_page_async
+
+        @ndb.tasklet
+        def fetch_then_write(query, *args, **kwargs):
+            page = yield fetch_page_async(query, *args, **kwargs)
+            yield [SomeModel(index=0).put_async()] + gaeutil.invalidate_search_cache('SomeModel')
+            raise ndb.Return(page)
+
+        with patch.object(ndb.Query, 'fetch_page_async', fetch_then_write):
+            self.assertListEqual([1, 2], self._search())
+        self.assertListEqual([0, 1], self._search())
+
+
+class IterPagesTests(GAETestCase):
+    def _assert_pages(self, lookahead):
+        ndb.put_multi([SomeModel(index=i) for i in xrange(10)])
+        cmd = ModelSearchCommand(SomeModel.query_index_ordered(), 3, offset=1)
+        pages = [[m.index for m in page] for page in cmd.iter_pages(lookahead)]
+        self.assertListEqual([[1, 2, 3], [4, 5, 6], [7, 8, 9]], pages)
+        self.assertFalse(cmd.more)
+
+    def test_without_lookahead(self):
+        self._assert_pages(0)
+
+    def test_lookahead(self):
+        self._assert_pages(1)
+
+    def test_lookahead_greater_than_pages(self):
+        self._assert_pages(5)
+
+    def test_prefetch(self):
+        ndb.put_multi([SomeModel(index=i) for i in xrange(10)])
+        cmd = ModelSearchCommand(SomeModel.query_index_ordered(), 2)
+        cmd.query.fetch_page_async = Mock(wraps=cmd.query.fetch_page_async)
+        pages = cmd.iter_pages(2)
+        self.assertListEqual([0, 1], [m.index for m in next(pages)])
+        self.assertGreaterEqual(cmd.query.fetch_page_async.call_count, 2, 'next page should be fetched ahead')
+        self.assertListEqual([2, 3], [m.index for m in next(pages)])
+        self.assertIsNotNone(cmd.cursor)
+        cursor = cmd.cursor
+        self.assertListEqual([[4, 5], [6, 7], [8, 9]], [[m.index for m in page] for page in pages])
+        resumed = ModelSearchCommand(SomeModel.query_index_ordered(), 2, cursor, use_cache=False)()
+        self.assertListEqual([4, 5], [m.index for m in resumed])
+
+
+class SearchCacheInvalidationTests(GAETestCase):
+    def _search(self):
+        return ModelSearchCommand(SomeModel.query_index_ordered(), 2)()
+
+    def _assert_invalidated_by(self, write_cmd):
+        self._search()
+        self.assertIsNotNone(self._search()[0].key.get())
+        write_cmd()
+        return [m.index for m in self._search()]
+
+    def test_save(self):
+        ndb.put_multi([SomeModel(index=i) for i in xrange(1, 3)])
+        self.assertListEqual([0, 1], self._assert_invalidated_by(NaiveSaveCommand(SomeModel, {'index': 0})))
+
+    def test_update(self):
+        keys = ndb.put_multi([SomeModel(index=i) for i in xrange(2)])
+        self.assertListEqual([-1, 0],
+                             self._assert_invalidated_by(NaiveUpdateCommand(SomeModel, keys[1], {'index': -1})))
+
+    def test_delete(self):
+        keys = ndb.put_multi([SomeModel(index=i) for i in xrange(3)])
+        self.assertListEqual([1, 2], self._assert_invalidated_by(DeleteCommand(keys[0])))
+
+    def test_invalidation_inside_parallel(self):
+        keys = ndb.put_multi([SomeModel(index=i) for i in xrange(2)])
+        self.assertListEqual([0, 2], self._assert_invalidated_by(
+            CommandParallel(NaiveUpdateCommand(SomeModel, keys[1], {'index': 2}), Command())))
+
+    def test_invalidation_inside_sequence(self):
+        keys = ndb.put_multi([SomeModel(index=i) for i in xrange(2)])
+        self._search()
+        search = ModelSearchCommand(SomeModel.query_index_ordered(), 2)
+        CommandSequential(NaiveUpdateCommand(SomeModel, keys[1], {'index': -1}), search)()
+        self.assertListEqual([-1, 0], [m.index for m in search.result],
+                             'search after a write on the same sequence should not be stale')
+
+    def test_invalidated_once_per_execution(self):
+        keys = ndb.put_multi([SomeModel(index=i) for i in xrange(20)])
+        with patch.object(gaeutil, 'invalidate_search_cache', wraps=gaeutil.invalidate_search_cache) as invalidate:
+            CommandParallel(*[NaiveUpdateCommand(SomeModel, key, {'index': -1}) for key in keys]).execute()
+        invalidate.assert_called_once_with('SomeModel')
+
+    def test_invalidate_on_write_disabled(self):
+        ndb.put_multi([SomeModel(index=i) for i in xrange(1, 3)])
+        self._search()
+        with patch.object(ModelSearchCommand, 'invalidate_on_write', False):
+            NaiveSaveCommand(SomeModel, {'index': 0})()
+        self.assertListEqual([1, 2], [m.index for m in self._search()])
+
+    def test_other_kinds_keep_cache(self):
+        ndb.put_multi([SomeModel(index=i) for i in xrange(2)])
+        self._search()
+        NaiveSaveCommand(ModelStub, {'name': 'foo', 'age': 1})()
+        cmd = ModelSearchCommand(SomeModel.query_index_ordered(), 2)
+        cmd.query.fetch_page_async = Mock(side_effect=AssertionError('search should be cached'))
+        self.assertListEqual([0, 1], [m.index for m in cmd()])
+
+    def test_parallel_searches_share_generation(self):
+        ndb.put_multi([SomeModel(index=i) for i in xrange(3)])
+        searches = [ModelSearchCommand(SomeModel.query(SomeModel.index >= i).order(SomeModel.index), 2) for i in xrange(2)]
+        # Each search computes a distinct generation, as happens when they run across a millisecond boundary
+        with patch.object(gaeutil, '_new_generation', side_effect=[1, 2]):
+            CommandParallel(*searches)()
+        generation = memcache.get(gaeutil._generation_key('SomeModel'))
+        for search in searches:
+            self.assertEqual(generation, memcache.get(search._cache_key())[2])
+
+    def test_generation_eviction(self):
+        ndb.put_multi([SomeModel(index=i) for i in xrange(1, 3)])
+        self._search()
+        memcache.delete(gaeutil._generation_key('SomeModel'))
+        SomeModel(index=0).put()
+        self.assertListEqual([0, 1], [m.index for m in self._search()])
+
+
 class SingleModelSearchTests(GAETestCase):
     def test_no_model_on_db(self):
         cmd = SingleModelSearchCommand(SomeModel.query())
@@ -245,6 +1092,22 @@ class NaiveUpdateCommandTests(GAETestCase):
     def test_update_with_key(self):
         self.assert_update(ndb.Key(ModelStub, 1))
 
+    def test_keys_fetched_together_on_parallel(self):
+        keys = ndb.put_multi([ModelStub(name='a', age=i) for i in xrange(3)])
+        cmds = [NaiveUpdateCommand(ModelStub, key, {'name': 'b'}) for key in keys]
+        ndb.get_context().clear_cache()
+        rpcs = _execute_recording_rpcs(CommandParallel(*cmds))
+        self.assertEqual(1, rpcs.count(('datastore_v3', 'Get')))
+        self.assertListEqual(['b', 'b', 'b'], [m.name for m in ndb.get_multi(keys)])
+
+    def test_keys_fetched_together_on_pipelined_sequence(self):
+        keys = ndb.put_multi([ModelStub(name='a', age=i) for i in xrange(3)])
+        cmds = [NaiveUpdateCommand(ModelStub, key, {'age': 10}) for key in keys]
+        ndb.get_context().clear_cache()
+        rpcs = _execute_recording_rpcs(CommandSequential(*cmds, pipeline=True))
+        self.assertEqual(1, rpcs.count(('datastore_v3', 'Get')))
+        self.assertListEqual([10, 10, 10], [m.age for m in ndb.get_multi(keys)])
+
 
 class NaiveFindOrCreateModelCommandTests(GAETestCase):
     def test_success(self):
@@ -419,3 +1282,55 @@ class FindOrCreateModelCommandTests(GAETestCase):
         self._assert_validation_errors(cmd, expected_error_keys)
 
 
+
+
+def _wait_without_blocking(future):
+    # Only waits made by gaebusiness code fail, since ndb itself blocks on some futures, like query's has_next
+    pending = future.state != apiproxy_rpc.RPC.FINISHING if isinstance(future, UserRPC) else not future.done()
+    if pending:
+        for filename, _, _, _ in reversed(traceback.extract_stack()[:-1]):
+            if not filename.endswith(('tasklets.py', 'mock.py', '<string>')):
+                if os.path.join('gaebusiness', '') in filename:
+                    raise AssertionError('%r should be yielded instead of waited' % future)
+                return
+
+
+class ExecuteAsyncTests(GAETestCase):
+    def _execute_async(self, *cmds):
+        """
+        Runs commands' execute_async on the event loop, failing if any of them blocks waiting for a future
+        """
+        futures = [cmd.execute_async() for cmd in cmds]
+        with patch.object(ndb.Future, 'wait', autospec=True, side_effect=_wait_without_blocking), \
+                patch.object(UserRPC, 'wait', autospec=True, side_effect=_wait_without_blocking):
+            ndb.eventloop.run()
+        return [future.get_result() for future in futures]
+
+    def test_writes(self):
+        key = ModelStub(name='a', age=1).put()
+        ndb.get_context().clear_cache()
+        self._execute_async(NaiveSaveCommand(ModelStub, {'name': 'b', 'age': 2}),
+                            NaiveUpdateCommand(ModelStub, key, {'age': 3}),
+                            UpdateModelStubCommand(key, name='c', age='4'),
+                            FindOrCreateModelStubCommand(ModelStub.query(ModelStub.name == 'd'), name='d', age='5'),
+                            NaiveFindOrCreateModelCommand(ModelStub.query(ModelStub.name == 'e'), ModelStub,
+                                                          {'name': 'e', 'age': 6}))
+        self.assertListEqual(['b', 'c', 'd', 'e'], sorted(m.name for m in ModelStub.query()))
+
+    def test_searches(self):
+        ndb.put_multi([SomeModel(index=i) for i in xrange(3)])
+        search, single = self._execute_async(ModelSearchCommand(SomeModel.query_index_ordered(), 2),
+                                             SingleModelSearchCommand(SomeModel.query_index_ordered()))
+        self.assertListEqual([0, 1], [m.index for m in search.result])
+        self.assertEqual(0, single.result.index)
+
+    def test_fetches_and_tasks(self):
+        apiproxy_stub_map.apiproxy.ReplaceStub('urlfetch', UrlFetchStubMock(200))
+        fetch, _ = self._execute_async(UrlFetchCommand('http://foo.bar.com/rest'), TaskQueueCommand('default', '/foo'))
+        self.assertEqual(200, fetch.result.status_code)
+
+    def test_parallel(self):
+        ndb.put_multi([SomeModel(index=i) for i in xrange(3)])
+        parallel, = self._execute_async(CommandParallel(ModelSearchCommand(SomeModel.query_index_ordered(), 2),
+                                                        NaiveSaveCommand(SomeModel, {'index': 3})))
+        self.assertListEqual([0, 1], [m.index for m in parallel[0].result])
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import json
+import unittest
+from google.appengine.ext import ndb
+from gaebusiness import tracing
+from gaebusiness.business import Command, CommandParallel, CommandExecutionException
+from gaebusiness.metrics import Histogram, MetricsRegistry
+from util import GAETestCase
+
+
+class MetricModel(ndb.Model):
+    name = ndb.StringProperty()
+
+
+class SaveMetricModel(Command):
+    def do_business(self):
+        self._to_commit = MetricModel(name='foo')
+
+
+class ErrorCommand(Command):
+    def do_business(self):
+        self.add_error('error', 'msg')
+
+
+class HistogramTests(unittest.TestCase):
+    def test_empty(self):
+        histogram = Histogram()
+        self.assertIsNone(histogram.percentile(50))
+        self.assertEqual(0, histogram.to_dict()['count'])
+
+    def test_percentiles(self):
+        histogram = Histogram((10, 100, 1000))
+        for value in [5] * 90 + [50] * 9 + [500]:
+            histogram.observe(value)
+        self.assertEqual(10, histogram.percentile(50))
+        self.assertEqual(100, histogram.percentile(95))
+        self.assertEqual(100, histogram.percentile(99))
+        self.assertEqual(500, histogram.percentile(100))
+        self.assertListEqual([90, 9, 1, 0], histogram.counts)
+
+    def test_overflow(self):
+        histogram = Histogram((10,))
+        histogram.observe(5)
+        histogram.observe(20, error=True)
+        self.assertEqual(20, histogram.percentile(99))
+        self.assertDictEqual({'count': 2, 'errors': 1, 'mean_ms': 12.5, 'max_ms': 20, 'p50_ms': 10, 'p95_ms': 20,
+                              'p99_ms': 20}, histogram.to_dict())
+
+
+class MetricsRegistryTests(GAETestCase):
+    def setUp(self):
+        super(MetricsRegistryTests, self).setUp()
+        self.registry = MetricsRegistry()
+        self.registry.install()
+
+    def tearDown(self):
+        self.registry.uninstall()
+        super(MetricsRegistryTests, self).tearDown()
+
+    def test_phases(self):
+        CommandParallel(SaveMetricModel(), SaveMetricModel()).execute()
+        SaveMetricModel().execute()
+        commands = self.registry.to_dict()['commands']
+        self.assertEqual(3, commands['SaveMetricModel']['do_business']['count'])
+        self.assertEqual(1, commands['SaveMetricModel']['execute']['count'])
+        self.assertEqual(1, commands['CommandParallel']['put']['count'])
+        self.assertGreaterEqual(self.registry.rpc_counts['datastore_v3'], 2)
+
+    def test_rpcs_by_phase(self):
+        SaveMetricModel().execute()
+        SaveMetricModel().execute()
+        phases = self.registry.to_dict()['commands']['SaveMetricModel']
+        self.assertEqual(0, phases['do_business']['rpcs'])
+        self.assertGreaterEqual(phases['put']['rpcs'], 2)
+        self.assertEqual(phases['put']['rpcs'] / 2.0, phases['put']['mean_rpcs'])
+        self.assertGreaterEqual(phases['execute']['rpcs'], phases['put']['rpcs'],
+                                'RPCs of nested phases should be included')
+
+    def test_errors(self):
+        self.assertRaises(CommandExecutionException, ErrorCommand().execute)
+        phases = self.registry.to_dict()['commands']['ErrorCommand']
+        self.assertEqual(1, phases['execute']['errors'])
+        self.assertEqual(0, phases['do_business']['errors'])
+
+    def test_uninstall(self):
+        self.registry.uninstall()
+        SaveMetricModel().execute()
+        self.assertDictEqual({'commands': {}, 'rpcs': {}}, self.registry.to_dict())
+        self.assertIs(tracing._NO_SPAN, tracing.trace(Command(), 'set_up'))
+
+    def test_dumps(self):
+        SaveMetricModel().execute()
+        self.assertEqual(self.registry.to_dict(), json.loads(self.registry.to_json()))
+        text = self.registry.to_text()
+        self.assertIn('SaveMetricModel.do_business count=1 errors=0', text)
+        self.assertIn('rpcs=0 mean_rpcs=0.0', text)
+        self.assertIn('rpcs.datastore_v3 ', text)
+        self.registry.reset()
+        self.assertEqual('', self.registry.to_text())
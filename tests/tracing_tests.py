@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+import json
+from google.appengine.ext import ndb
+from gaebusiness import tracing
+from gaebusiness.business import Command, CommandParallel, CommandSequential, CommandExecutionException
+from gaebusiness.tracing import Tracer, json_sink, trace
+from mock import patch
+from util import GAETestCase
+
+
+class TracedModel(ndb.Model):
+    name = ndb.StringProperty()
+
+
+class SaveTracedModel(Command):
+    def do_business(self):
+        self._to_commit = TracedModel(name='foo')
+
+
+class ErrorCommand(Command):
+    def do_business(self):
+        self.add_error('error', 'msg')
+
+
+def _phases(span):
+    return [(child.command_class, child.phase) for child in span.children]
+
+
+class TracerTests(GAETestCase):
+    def test_no_active_tracer(self):
+        with trace(Command(), 'set_up') as span:
+            self.assertIsNone(span)
+
+    def test_span_tree(self):
+        roots = []
+        with Tracer(roots.append):
+            CommandSequential(CommandParallel(SaveTracedModel(), Command()), SaveTracedModel()).execute()
+        self.assertEqual(1, len(roots))
+        root = roots[0]
+        self.assertEqual(('CommandSequential', 'execute'), (root.command_class, root.phase))
+        self.assertListEqual([('CommandSequential', 'set_up'), ('CommandSequential', 'do_business'),
+                              ('CommandSequential', 'commit'), ('CommandSequential', 'put'),
+                              ('CommandSequential', 'post_commit')], _phases(root))
+
+        sequential_business = root.children[1]
+        self.assertListEqual([('CommandParallel', 'execute'), ('SaveTracedModel', 'execute')],
+                             _phases(sequential_business))
+        parallel = sequential_business.children[0]
+        self.assertListEqual([('SaveTracedModel', 'set_up'), ('Command', 'set_up')],
+                             _phases(parallel.children[0]))
+        self.assertListEqual([('SaveTracedModel', 'commit'), ('Command', 'commit')],
+                             _phases(parallel.children[2]))
+        parallel_put = parallel.children[3]
+        self.assertGreater(parallel_put.rpcs, 0)
+        self.assertGreaterEqual(root.rpcs, parallel_put.rpcs)
+        self.assertGreaterEqual(root.duration, parallel.duration)
+        self.assertEqual(2, TracedModel.query().count())
+
+    def test_error(self):
+        roots = []
+        with Tracer(roots.append):
+            self.assertRaises(CommandExecutionException, ErrorCommand().execute)
+        self.assertEqual('CommandExecutionException', roots[0].error)
+        self.assertIsNone(roots[0].children[0].error)
+
+    def test_rpc_counts_by_service(self):
+        with Tracer(lambda span: None):
+            before = dict(tracing.rpc_counts())
+            TracedModel().put()
+        self.assertEqual(before.get('datastore_v3', 0) + 1, tracing.rpc_counts()['datastore_v3'])
+
+    def test_observers(self):
+        observed = []
+        observer = lambda *args: observed.append(args)
+        tracing.add_observer(observer)
+        tracing.install_rpc_counter()
+        try:
+            contexts = []
+            for phase in ('set_up', 'commit'):
+                context = trace(Command(), phase)
+                with context:
+                    contexts.append(context)
+            self.assertIs(contexts[0], contexts[1], 'context should be reused without an active Tracer')
+            SaveTracedModel().execute()
+            with Tracer(lambda span: None):
+                self.assertRaises(CommandExecutionException, ErrorCommand().execute)
+        finally:
+            tracing.remove_observer(observer)
+        observed = dict(((command_class, phase), (error, rpcs))
+                        for command_class, phase, duration, error, rpcs in observed)
+        self.assertEqual((None, 0), observed[('SaveTracedModel', 'set_up')])
+        self.assertIsNone(observed[('SaveTracedModel', 'put')][0])
+        self.assertGreater(observed[('SaveTracedModel', 'put')][1], 0)
+        self.assertEqual(observed[('SaveTracedModel', 'put')], observed[('SaveTracedModel', 'execute')])
+        self.assertEqual(('CommandExecutionException', 0), observed[('ErrorCommand', 'execute')])
+
+    def test_json_sink(self):
+        with patch.object(tracing.logging, 'info') as info:
+            with Tracer(json_sink):
+                SaveTracedModel().execute()
+        span_dict = json.loads(info.call_args[0][0])
+        self.assertEqual('SaveTracedModel', span_dict['command'])
+        self.assertEqual('execute', span_dict['phase'])
+        self.assertEqual(['set_up', 'do_business', 'commit', 'put', 'post_commit'],
+                         [c['phase'] for c in span_dict['children']])